@@ -2,6 +2,11 @@
 import operator
 import math
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class Vec3d(object):
     """3d vector class, supports vector and scalar operators,
@@ -433,6 +438,132 @@ class Vec3d(object):
     def __setstate__(self, dict):
         self.x, self.y, self.z = dict
 
+
+class Vec3dArray(object):
+    """N 3d vectors stored as three numpy arrays (structure of arrays),
+        with the high level functions of Vec3d applied to all of them at once.
+        other operands can be a Vec3dArray of the same length, a Vec3d or a triple.
+        """
+    __slots__ = ['x', 'y', 'z']
+
+    def __init__(self, x_or_vectors, y=None, z=None):
+        if y is None:
+            if isinstance(x_or_vectors, Vec3dArray):
+                x_or_vectors = (x_or_vectors.x, x_or_vectors.y, x_or_vectors.z)
+            else:
+                # sequence of triples, or (N, 3) array
+                x_or_vectors = np.asarray([tuple(v) for v in x_or_vectors], dtype=float).reshape(-1, 3).T
+            x_or_vectors, y, z = x_or_vectors
+        self.x = np.array(x_or_vectors, dtype=float)
+        self.y = np.array(y, dtype=float)
+        self.z = np.array(z, dtype=float)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)):
+            return Vec3d(float(self.x[key]), float(self.y[key]), float(self.z[key]))
+        return Vec3dArray(self.x[key], self.y[key], self.z[key])
+
+    def __repr__(self):
+        return 'Vec3dArray(%d vectors)' % len(self)
+
+    def as_array(self):
+        """return a (N, 3) array"""
+        return np.column_stack((self.x, self.y, self.z))
+
+    @staticmethod
+    def _xyz(other):
+        if isinstance(other, (Vec3dArray, Vec3d)):
+            return other.x, other.y, other.z
+        return other[0], other[1], other[2]
+
+    # vectory functions
+    def get_length_sqrd(self):
+        return self.x ** 2 + self.y ** 2 + self.z ** 2
+
+    def get_length(self):
+        return np.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
+
+    length = property(get_length, None, None, "gets the magnitudes of the vectors")
+
+    def rotate_around_z(self, angle_degrees):
+        radians = np.radians(angle_degrees)
+        cos = np.cos(radians)
+        sin = np.sin(radians)
+        self.x, self.y = self.x * cos - self.y * sin, self.x * sin + self.y * cos
+
+    def rotate_around_x(self, angle_degrees):
+        radians = np.radians(angle_degrees)
+        cos = np.cos(radians)
+        sin = np.sin(radians)
+        self.y, self.z = self.y * cos - self.z * sin, self.y * sin + self.z * cos
+
+    def rotate_around_y(self, angle_degrees):
+        radians = np.radians(angle_degrees)
+        cos = np.cos(radians)
+        sin = np.sin(radians)
+        self.z, self.x = self.z * cos - self.x * sin, self.z * sin + self.x * cos
+
+    def rotated_around_z(self, angle_degrees):
+        v = Vec3dArray(self)
+        v.rotate_around_z(angle_degrees)
+        return v
+
+    def rotated_around_x(self, angle_degrees):
+        v = Vec3dArray(self)
+        v.rotate_around_x(angle_degrees)
+        return v
+
+    def rotated_around_y(self, angle_degrees):
+        v = Vec3dArray(self)
+        v.rotate_around_y(angle_degrees)
+        return v
+
+    def get_angle_around_z(self):
+        # atan2(0, 0) is 0, as Vec3d for zero length vectors
+        return np.degrees(np.arctan2(self.y, self.x))
+
+    def get_angle_around_x(self):
+        return np.degrees(np.arctan2(self.z, self.y))
+
+    def get_angle_around_y(self):
+        return np.degrees(np.arctan2(self.x, self.z))
+
+    def get_angle_between(self, other):
+        x, y, z = self._xyz(other)
+        cos = self.dot(other) / (self.get_length() * np.sqrt(x ** 2 + y ** 2 + z ** 2))
+        return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+    def normalized(self):
+        length = self.get_length()
+        length = np.where(length != 0, length, 1.0)
+        return Vec3dArray(self.x / length, self.y / length, self.z / length)
+
+    def dot(self, other):
+        x, y, z = self._xyz(other)
+        return self.x * x + self.y * y + self.z * z
+
+    def projection(self, other):
+        x, y, z = self._xyz(other)
+        f = self.dot(other) / (x * x + y * y + z * z)
+        return Vec3dArray(x * f, y * f, z * f)
+
+    def cross(self, other):
+        x, y, z = self._xyz(other)
+        return Vec3dArray(self.y * z - self.z * y, self.z * x - self.x * z, self.x * y - self.y * x)
+
+    def convert_to_basis(self, x_vector, y_vector, z_vector):
+        return Vec3dArray(self.dot(x_vector) / Vec3dArray._length_sqrd(x_vector),
+                          self.dot(y_vector) / Vec3dArray._length_sqrd(y_vector),
+                          self.dot(z_vector) / Vec3dArray._length_sqrd(z_vector))
+
+    @staticmethod
+    def _length_sqrd(other):
+        x, y, z = Vec3dArray._xyz(other)
+        return x ** 2 + y ** 2 + z ** 2
+
 ########################################################################
 ## Unit Testing														  ##
 ########################################################################
@@ -566,6 +697,57 @@ if __name__ == "__main__":
             loaded_vec = pickle.loads(testvec_str)
             self.assertEquals(testvec, loaded_vec)
 
+    ####################################################################
+    @unittest.skipIf(np is None, "numpy not available")
+    class UnitTestVec3dArray(unittest.TestCase):
+        def setUp(self):
+            self.vectors = [Vec3d(1, .5, 3), Vec3d(0, 3, -3), Vec3d(-2, 7, .25), Vec3d(0, 0, 0)]
+            self.va = Vec3dArray(self.vectors)
+
+        def assertVectorsAlmostEqual(self, va, vectors):
+            self.assertEqual(len(va), len(vectors))
+            for i, v in enumerate(vectors):
+                self.assert_((va[i] - v).length < 1e-9)
+
+        def testCreationAndAccess(self):
+            self.assertEqual(len(self.va), 4)
+            self.assertEqual(self.va[2], Vec3d(-2, 7, .25))
+            self.assertEqual(Vec3dArray(self.va.x, self.va.y, self.va.z)[0], [1, .5, 3])
+            self.assertEqual(Vec3dArray(self.va.as_array())[1], [0, 3, -3])
+            self.assertEqual(len(self.va[1:3]), 2)
+
+        def testRotations(self):
+            for rotate in ('rotate_around_x', 'rotate_around_y', 'rotate_around_z'):
+                va = Vec3dArray(self.va)
+                getattr(va, rotate)(-37.5)
+                expected = []
+                for v in self.vectors:
+                    v = Vec3d(v)
+                    getattr(v, rotate)(-37.5)
+                    expected.append(v)
+                self.assertVectorsAlmostEqual(va, expected)
+            va = self.va.rotated_around_y([0, 90, 180, 270])
+            self.assertVectorsAlmostEqual(va, [v.rotated_around_y(a) for v, a in zip(self.vectors, [0, 90, 180, 270])])
+
+        def testAngles(self):
+            for i, v in enumerate(self.vectors):
+                self.assertAlmostEqual(self.va.get_angle_around_x()[i], v.get_angle_around_x())
+                self.assertAlmostEqual(self.va.get_angle_around_y()[i], v.get_angle_around_y())
+                self.assertAlmostEqual(self.va.get_angle_around_z()[i], v.get_angle_around_z())
+            self.assertAlmostEqual(self.va[:3].get_angle_between(Vec3d(4, 6, 1))[1],
+                                   Vec3d(0, 3, -3).get_angle_between(Vec3d(4, 6, 1)))
+
+        def testHighLevel(self):
+            rhs = Vec3d(4, 6, 1)
+            self.assertVectorsAlmostEqual(self.va.cross(rhs), [v.cross(rhs) for v in self.vectors])
+            self.assertVectorsAlmostEqual(self.va.cross(self.va), [Vec3d(0, 0, 0)] * 4)
+            self.assert_(list(self.va.dot(rhs)) == [v.dot(rhs) for v in self.vectors])
+            self.assertVectorsAlmostEqual(self.va.normalized(), [v.normalized() for v in self.vectors])
+            self.assertVectorsAlmostEqual(self.va.projection(rhs), [v.projection(rhs) for v in self.vectors])
+            basis = (Vec3d(5.0, 0, 0), Vec3d(0, .5, 0), Vec3d(0, 0, 3))
+            self.assertVectorsAlmostEqual(self.va.convert_to_basis(*basis),
+                                          [v.convert_to_basis(*basis) for v in self.vectors])
+
     ####################################################################
     unittest.main()
 
@@ -0,0 +1,782 @@
+# -*- coding: utf-8 -*-
+# benchmarks for the ephemeris code, and a regression suite for the
+# astronomy and kinematics hot paths (-s): timings can be saved to and
+# compared against a JSON baseline, results are checked against golden values.
+# benchmark-baseline.json holds the slowest of 5 runs of the reference machine:
+#   python benchmark.py -s --baseline=benchmark-baseline.json
+# -m measures the motion code in real time; the fast deterministic checks of
+# the fake backend are the unit tests of gpiobackend.py
+#
+
+import sys, getopt
+import timeit
+import math
+import json
+import logging
+import os
+import shutil
+import tempfile
+import contextlib
+import threading
+import time
+import datetime
+import sun
+import ephemeris
+import linearmotor
+import trackerdriver
+import pulsecounter
+import fakepigpiod
+import gpiobackend
+from Vec3d import Vec3d
+
+lon = 12.41
+lat = 41.9
+when = datetime.datetime(2015, 6, 21, 10, 30)
+
+
+def sun_az_alt_per_stage(gdatetime, lon_obs, lat_obs):
+    """sun_az_alt as it was before Epoch: every stage gets the datetime and
+    computes the julian date (and the nutation arguments) on its own."""
+    eclon = sun.sun_long(gdatetime) + sun.nutat_long(gdatetime) - 0.005694
+    ra, dec = sun.ecl_to_equ(eclon, 0, gdatetime)
+    return sun.equ_to_hor(ra, dec, gdatetime, lon_obs, lat_obs)
+
+
+def getpitchroll_vec3d(azi, ele):
+    """getpitchroll as it was before the closed form: rotate a Vec3d."""
+    vz = math.sin(math.radians(ele))
+    vx = -math.cos(math.radians(azi)) * math.cos(math.radians(ele))
+    vy = math.sin(math.radians(azi)) * math.cos(math.radians(ele))
+    v = Vec3d(vy, vx, vz)
+    pitch = v.get_angle_around_x() - 90
+    v.rotate_around_x(-pitch)
+    roll = v.get_angle_around_y()
+
+    return pitch, roll
+
+
+@contextlib.contextmanager
+def tempstatefile():
+    """
+      path of a motor state file in a new private directory, removed with it
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        yield os.path.join(directory, "motor.dat")
+    finally:
+        shutil.rmtree(directory)
+
+
+def percall(fn, number):
+    """Return best time per call in microseconds."""
+    t = min(timeit.repeat(fn, repeat=5, number=number))
+    return t * 1e6 / number
+
+
+def bench_epoch(number):
+    old = percall(lambda: sun_az_alt_per_stage(when, lon, lat), number)
+    new = percall(lambda: sun.sun_az_alt(when, lon, lat), number)
+    print "sun_az_alt per stage  %8.2f us/call" % old
+    print "sun_az_alt with Epoch %8.2f us/call" % new
+    print "speedup               %8.2fx" % (old / new)
+    if sun_az_alt_per_stage(when, lon, lat) != sun.sun_az_alt(when, lon, lat):
+        print "ERROR: results differ"
+        return False
+    return True
+
+
+def bench_chebyshev(number):
+    ce = sun.ChebyshevEphemeris()
+    jd = sun.cd_to_jd(when)
+    full = percall(lambda: sun.sun_az_alt_jd(jd, lon, lat), number)
+    fit = percall(lambda: ce.sun_az_alt_jd(jd, lon, lat), number)
+    print "sun_az_alt_jd         %8.2f us/call" % full
+    print "chebyshev lookup      %8.2f us/call" % fit
+    print "speedup               %8.2fx" % (full / fit)
+    # a day every minute
+    err = 0.0
+    for m in xrange(1440):
+        t = jd + m / 1440.0
+        a = sun.sun_az_alt_jd(t, lon, lat)
+        b = ce.sun_az_alt_jd(t, lon, lat)
+        err = max(err, abs(a[1] - b[1]), abs((a[0] - b[0] + 180.0) % 360.0 - 180.0) * math.cos(math.radians(a[1])))
+    print "chebyshev max error   %8.2e deg" % err
+    return err < 1e-4
+
+
+def bench_almanac():
+    """one year of twilight and tracking times, sun_time per event against almanac"""
+    angles = (6, -6)
+    start = when.date()
+    jd0 = sun.cd_to_jd(start) + 0.5
+
+    def per_event():
+        for d in xrange(365):
+            noon = sun.local_noon_jd(jd0 + d, lon)
+            for angle in angles:
+                sun.sun_time_jd(noon, lon, lat, True, angle)
+                sun.sun_time_jd(noon, lon, lat, False, angle)
+
+    old = min(timeit.repeat(per_event, repeat=3, number=1))
+    new = min(timeit.repeat(lambda: sun.almanac(lon, lat, start, 365, angles), repeat=3, number=1))
+    print "sun_time, one year    %8.2f ms" % (old * 1e3)
+    print "almanac, one year     %8.2f ms" % (new * 1e3)
+    print "speedup               %8.2fx" % (old / new)
+    events = sun.almanac(lon, lat, start, 365, angles)
+    for d in xrange(0, 365, 7):
+        noon = sun.local_noon_jd(jd0 + d, lon)
+        if events[6][1][d] != sun.sun_time_jd(noon, lon, lat, True, 6)[1]:
+            print "ERROR: almanac differs from sun_time"
+            return False
+    return True
+
+
+def bench_stepper(number):
+    """stepping a tracking loop at 1 s intervals for 12 hours against the full engine"""
+    jd0 = sun.cd_to_jd(when.date()) + 0.25
+    stepper = ephemeris.SunStepper(lon, lat, jd0, 1)
+    full = percall(lambda: sun.sun_az_alt_jd(jd0, lon, lat), number)
+    step = percall(stepper.step, number)
+    print "sun_az_alt_jd         %8.2f us/call" % full
+    print "stepper step          %8.2f us/call" % step
+    print "speedup               %8.2fx" % (full / step)
+    stepper = ephemeris.SunStepper(lon, lat, jd0, 1)
+    err = 0.0
+    for s in xrange(1, 43200):
+        p = stepper.step()
+        if s % 60 == 0:
+            err = max(err, angular_distance(p, sun.sun_az_alt_jd(jd0 + s / 86400.0, lon, lat)))
+    print "stepper max error     %8.2e deg, %d anchors" % (err, stepper.anchors)
+    return err < stepper.maxerror
+
+
+def bench_pitchroll(number):
+    """closed form getpitchroll against the Vec3d rotation, every degree of the sky"""
+    old = percall(lambda: getpitchroll_vec3d(150.0, 45.0), number)
+    new = percall(lambda: trackerdriver.getpitchroll(150.0, 45.0), number)
+    print "getpitchroll Vec3d    %8.2f us/call" % old
+    print "getpitchroll closed   %8.2f us/call" % new
+    print "speedup               %8.2fx" % (old / new)
+    err = 0.0
+    for az in xrange(0, 360):
+        for el in xrange(0, 91):
+            a = getpitchroll_vec3d(az, el)
+            b = trackerdriver.getpitchroll(az, el)
+            err = max(err, abs(a[0] - b[0]), abs(a[1] - b[1]))
+    print "getpitchroll max diff %8.2e deg" % err
+    return err < 1e-9
+
+
+def bench_pipeline():
+    """azi, ele -> pitch, roll -> motor positions for a day of minute steps, scalar against arrays"""
+    if sun.np is None:
+        print "pipeline: numpy not available, skipped"
+        return True
+    np = sun.np
+    pitch, roll = make_motors()
+    pitch.setanglerange(-60, 60)
+    roll.setanglerange(-60, 60)
+    with tempstatefile() as statefile:
+        td = trackerdriver.TrackerDriver(pitch, roll, 5.0, statefile)
+    ts = sun.jd_to_unix(sun.cd_to_jd(when.date()) + np.arange(0, 1, 1 / 1440.0))
+    az, alt = sun.sun_az_alt_array(ts, lon, lat)
+    day = alt > 0
+    az = az[day]
+    alt = alt[day]
+
+    def scalar():
+        result = []
+        for a, e in zip(az, alt):
+            p, r = trackerdriver.getpitchroll((a + td.aziOffset) % 360.0, e)
+            p = pitch.fixangle(p)
+            r = roll.fixangle(r)
+            result.append((p, r, pitch.angle2pos(p), roll.angle2pos(r)))
+        return result
+
+    old = min(timeit.repeat(scalar, repeat=3, number=1))
+    new = min(timeit.repeat(lambda: td.aziele2pos_array(az, alt), repeat=3, number=1))
+    print "aziele to pos, scalar %8.2f ms for %d steps" % (old * 1e3, len(az))
+    print "aziele2pos_array      %8.2f ms" % (new * 1e3)
+    print "speedup               %8.2fx" % (old / new)
+    err = np.abs(np.array(scalar()) - np.column_stack(td.aziele2pos_array(az, alt))).max()
+    print "pipeline max diff     %8.2e" % err
+    return err < 1e-9
+
+
+class PulseSource(threading.Thread):
+    """
+      simulated reed sensor: feeds a motor 'rate' pulses per second while its power is on
+      and for 'coast' seconds after
+    """
+
+    def __init__(self, motor, rate, coast=0.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.motor = motor
+        self.period = 1.0 / rate
+        self.coast = coast
+        self.level = 0
+        # edges left before the end stop, None for no end stop
+        self.endstop = None
+        self.running = True
+
+    def run(self):
+        tnext = time.time()
+        tstop = 0
+        while self.running:
+            tnext += self.period / 2
+            time.sleep(max(0.0, tnext - time.time()))
+            if self.motor.power:
+                tstop = time.time() + self.coast
+            elif time.time() >= tstop:
+                tnext = time.time()
+                continue
+            if self.endstop is not None:
+                if self.endstop <= 0:
+                    continue
+                self.endstop -= 1
+            self.level ^= 1
+            self.motor.edgepulse(level=self.level, tick=int(time.time() * 1e6) & 0xffffffff)
+
+
+def bench_motion(rate=100.0, coast=0.05):
+    """
+      final error and stop latency of gopos with simulated pulses and coasting:
+      checking the target every 100 ms (as before edgepulse cut the power),
+      cutting on the target edge with the fixed stop rule, and learning the
+      coast; the last variant is recorded and replayed offline
+    """
+    latencies = []
+
+    def gpio_out(port, value, label=""):
+        # the tick of the edge that reached the target is in motor.cut
+        if port == motor.powerPort and value == 0 and motor.cut is not None:
+            latencies.append(((int(time.time() * 1e6) - motor.cut[4]) & 0xffffffff) / 1000.0)
+
+    motor = make_motors()[0]
+    motor.set_gpioout(gpio_out)
+    motor.wait = 0
+    source = PulseSource(motor, rate, coast)
+    source.start()
+    targets = (60, 10, 75, 20, 95, 30) * 2
+    ok = True
+    for name, stoppoll, learnrate in (("polling", .1, 0), ("fixed", None, 0), ("learned", None, motor.LEARNRATE)):
+        motor.stopPoll = stoppoll
+        motor.learnRate = learnrate
+        motor.speed = {1: None, -1: None}
+        motor.coastTime = {1: None, -1: None}
+        errors = []
+        del latencies[:]
+        motor.pos = 0
+        motor.startrecording()
+        glitches = motor.glitches
+        for target in targets:
+            direction = 1 if target > motor.pos else -1
+            motor.gopos(target)
+            time.sleep(coast + .1)
+            errors.append((motor.pos - target) * direction)
+        events = motor.stoprecording()
+        last = errors[len(targets) // 2:]
+        line = "%-8s %5.0f pulses/s, %3.0f ms coast: error past target, last %d moves %+d..%+d pulses" % (
+            name, rate, coast * 1000, len(last), min(last), max(last))
+        if latencies:
+            line += ", stop latency %.1f ms max" % max(latencies)
+        print line
+        if name == "learned":
+            ok = max(abs(e) for e in last) <= 2
+    source.running = False
+    source.join()
+
+    # replay the last variant offline, through a file
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        linearmotor.saveevents(filename, events)
+        replayed = linearmotor.replayevents(make_motors()[0], linearmotor.loadevents(filename))
+    finally:
+        os.remove(filename)
+    stats = motor.motionstats()
+    glitches = stats["glitches"] - glitches
+    print "replay   %d edges: pos %d (live %d), %d glitches (live %d), %d edges lost" % (
+        len(events[0]), replayed.pos, motor.pos, replayed.glitches, glitches, stats["overruns"])
+    if replayed.pos != motor.pos or replayed.glitches != glitches:
+        print "ERROR: replayed motion differs"
+        ok = False
+
+    # pulse callback and batch processing cost
+    motor = make_motors()[0]
+    motor.set_gpioout(gpio_out)
+    print "edgepulse             %8.3f us/edge" % percall(lambda: motor.edgepulse(level=motor.written & 1, tick=0),
+                                                          100000)
+    batch = motor.RING - 1
+
+    def consume():
+        motor.written = motor.consumed + batch
+        motor.consume()
+
+    print "consume               %8.3f us/edge" % (percall(consume, 100) / batch)
+    return ok
+
+
+def bench_calibrate(rate=100.0, travel=150, drift=7):
+    """
+      calibration time and drift found from 'travel' pulses with 'drift' pulses lost,
+      a fixed 0.4 s window (as before end stop detection) against end stop detection
+    """
+    motor = make_motors()[0]
+    motor.set_gpioout(lambda port, value, label="": None)
+    motor.wait = 0
+    source = PulseSource(motor, rate)
+    source.start()
+    ok = True
+    for name, calibratepoll in (("polling", .4), ("endstop", None)):
+        motor.calibratePoll = calibratepoll
+        motor.pos = travel + drift
+        source.endstop = 2 * travel
+        t = time.time()
+        found = motor.calibrate()[1]
+        t = time.time() - t
+        print "%-8s %5.0f pulses/s: %d pulses in %.2f s (%.2f s after the end stop), drift %s" % (
+            name, rate, travel, t, t - travel / rate, found)
+        ok = ok and found == drift
+    source.running = False
+    source.join()
+
+    # both axes, one after the other and at the same time
+    pitch, roll = make_motors()
+    sources = []
+    for motor in (pitch, roll):
+        motor.set_gpioout(lambda port, value, label="": None)
+        sources.append(PulseSource(motor, rate))
+        sources[-1].start()
+    with tempstatefile() as statefile:
+        driver = trackerdriver.TrackerDriver(pitch, roll, 0, statefile=statefile)
+        for name, calibrate in (("one by one", lambda: [pitch.calibrate(), roll.calibrate()]),
+                                ("both", driver.calibrateboth)):
+            for motor, source, pulses in zip((pitch, roll), sources, (travel, 2 * travel)):
+                motor.wait = 0
+                motor.pos = pulses + drift
+                source.endstop = 2 * pulses
+            t = time.time()
+            found = [r[1] for r in calibrate()]
+            print "%-10s %5.0f pulses/s: %d and %d pulses in %.2f s, drift %s" % (name, rate, travel, 2 * travel,
+                                                                                time.time() - t, found)
+            ok = ok and found == [drift, drift]
+    for source in sources:
+        source.running = False
+        source.join()
+    return ok
+
+
+def bench_relays(rate=100.0, moves=5, step=30):
+    """
+      command latency (until both motors are powered) and gpio calls of two axis
+      moves in the same direction: writing and waiting for the direction relays
+      on every move (as before relay tracking), tracking the relay settle time,
+      and tracking it with bank writes
+    """
+    calls = []
+    poweron = []
+    powerports = []
+
+    def gpio_out(port, value, label=""):
+        calls.append(port)
+        if value and port in powerports:
+            poweron.append(time.time())
+
+    def bank_write(setmask, clearmask):
+        calls.append(None)
+        if setmask & sum(1 << port for port in powerports):
+            poweron.append(time.time())
+
+    for name, trackrelay, gpiobank in (("sleep", False, None), ("tracked", True, None),
+                                       ("bank", True, linearmotor.GpioBank(gpio_out, bank_write))):
+        # new motors, with their relays in the power on state
+        pitch, roll = make_motors()
+        powerports[:] = (pitch.powerPort, roll.powerPort)
+        sources = []
+        for motor in (pitch, roll):
+            motor.trackRelay = trackrelay
+            if gpiobank:
+                gpiobank.attach(motor)
+            else:
+                motor.set_gpioout(gpio_out)
+            sources.append(PulseSource(motor, rate))
+            sources[-1].start()
+        latencies = []
+        del calls[:]
+        with tempstatefile() as statefile:
+            driver = trackerdriver.TrackerDriver(pitch, roll, 0, statefile=statefile)
+            driver.gpioBank = gpiobank
+            for i in xrange(1, moves + 1):
+                del poweron[:]
+                t = time.time()
+                driver.gotopitchrollpos(i * step, i * step)
+                latencies.append((poweron[-1] - t) * 1000)
+        for source in sources:
+            source.running = False
+            source.join()
+        print "%-8s %d moves: latency first %.1f ms, then %.1f ms mean, %.1f gpio calls per move" % (
+            name, moves, latencies[0], sum(latencies[1:]) / (moves - 1), float(len(calls)) / moves)
+    return True
+
+
+def bench_fake(moves=8):
+    """
+      two axis moves on the deterministic fake backend: motor positions against the
+      fake actuators, and the backend latency histograms
+    """
+    backend = gpiobackend.FakeBackend()
+    pitch, roll = make_motors()
+    bank = linearmotor.GpioBank(backend.write, backend.bank_write)
+    for motor in (pitch, roll):
+        backend.addmotor(motor.powerPort, motor.dirPort, motor.pulsePort)
+        motor.setbackend(backend)
+        bank.attach(motor)
+        # the fake actuators are done when the power write returns
+        motor.wait = 0
+        motor.settleQuiet = 0
+    with tempstatefile() as statefile:
+        driver = trackerdriver.TrackerDriver(pitch, roll, 0, statefile=statefile)
+        driver.gpioBank = bank
+        ok = True
+        t = time.time()
+        for i in xrange(moves):
+            driver.gotopitchrollpos(100 + 37 * i % 200, 300 - 53 * i % 250)
+            for motor in (pitch, roll):
+                ok = ok and motor.pos == backend.motors[motor.powerPort].pos
+    print "fake     %d moves in %.2f s, motor positions %s the actuators" % (moves, time.time() - t,
+                                                                          "match" if ok else "DIFFER from")
+    for line in backend.latencysummary():
+        print "  %s" % line
+    return ok
+
+
+def bench_day(step=60, glitch=0.0):
+    """
+      a day of tracking moves, every 'step' s, on virtual actuators with spin-up,
+      coast and bouncing pulses, in virtual time: error past target and duration
+      of the moves, motor positions against the actuators
+    """
+    backend = gpiobackend.FakeBackend()
+    pitch, roll = make_motors()
+    bank = linearmotor.GpioBank(backend.write, backend.bank_write)
+    actuators = []
+    for seed, motor in enumerate((pitch, roll)):
+        actuators.append(backend.addmotor(motor.powerPort, motor.dirPort, motor.pulsePort, rate=100.0,
+                                          reverserate=90.0, spinup=0.1, coast=0.1, glitch=glitch, seed=seed))
+        motor.setbackend(backend)
+        bank.attach(motor)
+        motor.wait = 0
+        motor.settleQuiet = 0
+    with tempstatefile() as statefile:
+        driver = trackerdriver.TrackerDriver(pitch, roll, 0, statefile=statefile)
+        driver.gpioBank = bank
+        day = datetime.datetime(when.year, when.month, when.day)
+        errors = ([], [])
+        t = time.time()
+        for s in xrange(0, 86400, step):
+            backend.advance(step)
+            az, alt = sun.sun_az_alt(day + datetime.timedelta(seconds=s), lon, lat)
+            if alt < 5:
+                continue
+            moves = [(len(actuator.moves), None not in motor.coastTime.values())
+                     for motor, actuator in zip((pitch, roll), actuators)]
+            driver.gotoaziele(az, alt)
+            for motor, actuator, (n, learned), e in zip((pitch, roll), actuators, moves, errors):
+                if len(actuator.moves) > n:
+                    e.append((learned, motor.finalErrors[-1]))
+        elapsed = time.time() - t
+    print "day      %s every %d s, %.1f h virtual in %.2f s, bounce probability %g" % (
+        day.date(), step, backend.now / 3600, elapsed, glitch)
+    ok = elapsed < 60
+    for motor, actuator, e in zip((pitch, roll), actuators, errors):
+        durations = [stop - start for start, stop, pulses in actuator.moves]
+        first = [error for learned, error in e if not learned]
+        e = [error for learned, error in e if learned]
+        print "  %-7s %3d moves %.2f..%.2f s (mean %.2f s), error past target %+.1f..%+.1f pulses " \
+              "(first moves, coast not learned: up to %+.1f), position off by %+d pulses after %d bounces" % (
+                  motor.name, len(durations), min(durations), max(durations), sum(durations) / len(durations),
+                  min(e), max(e), max(first), motor.pos - actuator.pos, actuator.bounces)
+        if not glitch:
+            ok = ok and motor.pos == actuator.pos and max(abs(x) for x in e) <= 1
+    return ok
+
+
+def bench_pigpiod(rate=100.0, coast=0.05):
+    """
+      final error of gopos with pulses counted and the power cut by a pigpiod
+      script, against the fake pigpiod
+    """
+    server = fakepigpiod.FakePigpiod()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = pulsecounter.PigpiodClient(*server.server_address)
+    motor = make_motors()[0]
+    motor.set_gpioout(lambda port, value, label="": client.write(port, value))
+    motor.wait = 0
+    server.addmotor(motor.pulsePort, motor.powerPort, rate, coast)
+    motor.setpulsecounter(pulsecounter.PulseCounter(client, motor.pulsePort, motor.powerPort))
+    targets = (60, 10, 75, 20, 95, 30) * 2
+    errors = []
+    for target in targets:
+        direction = 1 if target > motor.pos else -1
+        motor.gopos(target)
+        time.sleep(coast + .1)
+        errors.append((motor.pos - target) * direction)
+    motor.counter.close()
+    client.close()
+    server.shutdown()
+    last = errors[len(targets) // 2:]
+    print "pigpiod  %5.0f pulses/s, %3.0f ms coast: error past target, last %d moves %+d..%+d pulses, " \
+          "%d glitches" % (rate, coast * 1000, len(last), min(last), max(last), motor.glitches)
+    return max(abs(e) for e in last) <= 2
+
+
+def bench_sites():
+    """one year hourly for 20 sites, per site against broadcast over the sites"""
+    if sun.np is None:
+        print "sites: numpy not available, skipped"
+        return True
+    np = sun.np
+    jd0 = sun.cd_to_jd(when.date())
+    ts = sun.jd_to_unix(jd0 + np.arange(0, 365, 1 / 24.0))
+    lons = np.linspace(-120.0, 140.0, 20)
+    lats = np.linspace(-50.0, 60.0, 20)
+    old = min(timeit.repeat(lambda: [sun.sun_az_alt_array(ts, lo, la) for lo, la in zip(lons, lats)],
+                            repeat=3, number=1))
+    new = min(timeit.repeat(lambda: sun.sun_az_alt_sites(ts, lons, lats), repeat=3, number=1))
+    print "sun_az_alt_array x20  %8.2f ms" % (old * 1e3)
+    print "sun_az_alt_sites      %8.2f ms" % (new * 1e3)
+    print "speedup               %8.2fx" % (old / new)
+    az, alt = sun.sun_az_alt_sites(ts, lons, lats)
+    for i in xrange(len(lons)):
+        if not (az[i] == sun.sun_az_alt_array(ts, lons[i], lats[i])[0]).all():
+            print "ERROR: sun_az_alt_sites differs from sun_az_alt_array"
+            return False
+    return True
+
+
+def angular_distance(a, b):
+    """angle in degrees between two (azimuth, altitude) directions"""
+    az1, alt1 = math.radians(a[0]), math.radians(a[1])
+    az2, alt2 = math.radians(b[0]), math.radians(b[1])
+    # haversine formula, accurate for small angles
+    h = math.sin((alt2 - alt1) / 2) ** 2 + math.cos(alt1) * math.cos(alt2) * math.sin((az2 - az1) / 2) ** 2
+    return math.degrees(2 * math.asin(math.sqrt(min(1.0, h))))
+
+
+def bench_engines(number, tablefile=None, tolerance=None):
+    """ns/call and maximum error against the precise tier for every engine"""
+    engines = [ephemeris.FullEngine(), ephemeris.ChebyshevEngine()]
+    site = (lon, lat)
+    jd0 = sun.cd_to_jd(when.date())
+    if tablefile:
+        table = ephemeris.TableEngine(tablefile)
+        engines.insert(0, table)
+        site = (table.table.lon, table.table.lat)
+        jd0 = table.table.jd0
+    precise = ephemeris.SpaEngine()
+    engines.append(precise)
+
+    # one year, 4 samples a day at shifting times
+    samples = [jd0 + d + (h * 6 + d % 6) / 24.0 for d in xrange(365) for h in xrange(4)]
+    reference = [precise.sun_az_alt_jd(jd, site[0], site[1]) for jd in samples]
+
+    measured = []
+    for engine in engines:
+        jd = samples[len(samples) // 3]
+        n = max(number // 100, 10) if engine.tier == ephemeris.PRECISE else number
+        ns = percall(lambda: engine.sun_az_alt_jd(jd, site[0], site[1]), n) * 1000
+        err = max(angular_distance(engine.sun_az_alt_jd(t, site[0], site[1]), r)
+                  for t, r in zip(samples, reference))
+        print "%-10s %-8s %10.0f ns/call  max error %.6f deg (declared %.6f)" % (engine.name, engine.tier, ns, err,
+                                                                                engine.maxerror)
+        measured.append((ns, err, engine))
+
+    ok = all(err <= engine.maxerror for ns, err, engine in measured)
+    if not ok:
+        print "ERROR: an engine exceeds its declared maximum error"
+    if tolerance is not None:
+        fits = sorted((ns, engine.name) for ns, err, engine in measured if err <= tolerance)
+        if fits:
+            print "cheapest engine within %f deg: %s" % (tolerance, fits[0][1])
+        else:
+            print "no engine within %f deg" % tolerance
+    return ok
+
+
+# relative tolerance of the golden values
+SUITE_TOLERANCE = 1e-9
+
+# (case, case it must beat): a cache slower than what it caches is a bug
+SUITE_FASTER = [
+    ("LinearMotor.angle2pos cached", "LinearMotor.angle2pos"),
+]
+
+
+def make_motors():
+    """pitch and roll motors with the geometry of trackerdriver.py"""
+    pitch = linearmotor.LinearMotor("[pitch]", dirport=21, powerport=19, pulseport=3, pulsestep=0.522, ab=225, bc=355,
+                                    cd=40, d=-5, offset=136, hookoffset=34)
+    roll = linearmotor.LinearMotor("[roll]", dirport=16, powerport=15, pulseport=5, pulsestep=0.522, ab=225, bc=708,
+                                   cd=40, d=75, offset=503)
+    return pitch, roll
+
+
+def rotate_vec3d():
+    v = Vec3d(0.3, -0.5, 0.8)
+    v.rotate_around_x(30)
+    v.rotate_around_y(-20)
+    v.rotate_around_z(45)
+    return v.get_angle_around_x(), v.get_angle_around_y(), v.get_angle_around_z()
+
+
+def suite_cases():
+    """
+      (name, function, golden result) for every benchmarked call
+    """
+    pitch, roll = make_motors()
+    cpitch, croll = make_motors()
+    cpitch.setangle2poscache(0.01)
+    croll.setangle2poscache(0.01)
+    return [
+        ("sun.sun_az_alt", lambda: sun.sun_az_alt(when, lon, lat),
+         (151.34225069197086, 69.5603046123876)),
+        ("sun.sun_time", lambda: sun.sun_time(when, lon, lat, True, 6)[1],
+         datetime.datetime(2015, 6, 21, 3, 0, 44, 241200)),
+        ("trackerdriver.getpitchroll", lambda: trackerdriver.getpitchroll(150.0, 45.0),
+         (-40.89339464913091, 20.704811054635428)),
+        ("LinearMotor.angle2pos", lambda: (pitch.angle2pos(35.0), roll.angle2pos(-20.0)),
+         (693.6829336942178, 263.37949620240795)),
+        ("LinearMotor.angle2pos cached", lambda: (cpitch.angle2pos(35.0), croll.angle2pos(-20.0)),
+         (693.6829336942178, 263.37949620240795)),
+        ("Vec3d.rotate", rotate_vec3d,
+         (133.76247220204579, 52.7144099003103, -36.099462387873835)),
+    ]
+
+
+def flatten(value):
+    """list of floats from a result: numbers, datetimes (seconds from 'when') and nested tuples"""
+    if isinstance(value, datetime.datetime):
+        return [(value - when).total_seconds()]
+    if isinstance(value, (tuple, list)):
+        return [x for v in value for x in flatten(v)]
+    return [float(value)]
+
+
+def suite(number, save=None, baseline=None, margin=0.2):
+    """
+      time every case, check it against its golden value, the baseline and SUITE_FASTER
+    """
+    base = None
+    if baseline:
+        f = open(baseline, 'r')
+        base = json.load(f)
+        f.close()
+
+    ok = True
+    results = {}
+    for name, fn, golden in suite_cases():
+        us = percall(fn, number)
+        results[name] = us
+        line = "%-30s %8.2f us/call" % (name, us)
+        got = flatten(fn())
+        want = flatten(golden)
+        if len(got) != len(want) or any(abs(g - w) > SUITE_TOLERANCE * max(1.0, abs(w)) for g, w in zip(got, want)):
+            line += "  ERROR: %s, golden %s" % (got, want)
+            ok = False
+        if base is not None and name in base:
+            change = us / base[name] - 1.0
+            line += "  %+6.1f%% vs baseline" % (change * 100)
+            if change > margin:
+                line += "  ERROR: slower than %.0f%% margin" % (margin * 100)
+                ok = False
+        print line
+
+    for fast, slow in SUITE_FASTER:
+        if results[fast] >= results[slow]:
+            print "ERROR: %s (%.2f us) is not faster than %s (%.2f us)" % (fast, results[fast], slow, results[slow])
+            ok = False
+
+    if save:
+        f = open(save, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+        print "results saved to %s" % save
+    return ok
+
+
+def usage():
+    print "Usage : %s [-n,--number=<calls per repeat, default 10000>] [-e,--engines] [--table=<ephemeris table>] " \
+          "[--tolerance=<degrees>] [-s,--suite] [--save=<json file>] [--baseline=<json file>] " \
+          "[--margin=<allowed slowdown, default 0.2>] [-m,--motion] [-h,--help]" % (sys.argv[0])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    number = 10000
+    engines = False
+    tablefile = None
+    tolerance = None
+    runsuite = False
+    save = None
+    baseline = None
+    margin = 0.2
+    motion = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:esm", ["help", "number=", "engines", "table=", "tolerance=",
+                                                             "suite", "save=", "baseline=", "margin=", "motion"])
+    except getopt.GetoptError:
+        print "Error parsing argument:", sys.exc_info()[1]
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-n", "--number"):
+            number = int(a)
+        if o in ("-e", "--engines"):
+            engines = True
+        if o == "--table":
+            tablefile = a
+        if o == "--tolerance":
+            tolerance = float(a)
+        if o in ("-s", "--suite"):
+            runsuite = True
+        if o == "--save":
+            save = a
+        if o == "--baseline":
+            baseline = a
+        if o == "--margin":
+            margin = float(a)
+        if o in ("-m", "--motion"):
+            motion = True
+
+    linearmotor.log = logging.getLogger("linearmotor")
+    linearmotor.log.setLevel(logging.ERROR)
+    trackerdriver.log = logging.getLogger("trackerdriver")
+    trackerdriver.log.setLevel(logging.ERROR)
+
+    if runsuite:
+        ok = suite(number, save, baseline, margin)
+    elif motion:
+        ok = bench_motion()
+        ok = bench_pigpiod() and ok
+        ok = bench_calibrate() and ok
+        ok = bench_relays() and ok
+        ok = bench_fake() and ok
+        ok = bench_day() and ok
+        ok = bench_day(glitch=0.002) and ok
+    elif engines:
+        ok = bench_engines(number, tablefile, tolerance)
+    else:
+        ok = bench_epoch(number)
+        ok = bench_chebyshev(number) and ok
+        ok = bench_almanac() and ok
+        ok = bench_stepper(number) and ok
+        ok = bench_sites() and ok
+        ok = bench_pitchroll(number) and ok
+        ok = bench_pipeline() and ok
+    sys.exit(0 if ok else 1)
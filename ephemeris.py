@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+# ephemeris engines
+#
+# An engine computes the sun position for a site; engines trade accuracy for
+# speed and can be selected by name, or as the cheapest one meeting a
+# pointing tolerance.
+#
+
+import abc
+import math
+import logging
+import sun
+import spa
+
+log = logging.getLogger("ephemeris")
+
+FAST = "fast"
+PRECISE = "precise"
+
+
+class Engine(object):
+    """
+      sun position engine interface
+    """
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+    tier = FAST
+    # maximum angular error in degrees against the precise tier, as measured
+    # by UnitTestEngines over years 2000-2050 (0 for the precise tier itself)
+    maxerror = None
+
+    def sun_az_alt(self, gdatetime, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun for a Greenwich datetime."""
+        return self.sun_az_alt_jd(sun.cd_to_jd(gdatetime), lon_obs, lat_obs)
+
+    @abc.abstractmethod
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun for a Julian date."""
+
+
+class FullEngine(Engine):
+    """
+      the low precision algorithm in sun.py
+    """
+    name = "full"
+    # 0.0101 measured, in 2020
+    maxerror = 0.011
+
+    def sun_az_alt(self, gdatetime, lon_obs, lat_obs):
+        return sun.sun_az_alt(gdatetime, lon_obs, lat_obs)
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        return sun.sun_az_alt_jd(jd, lon_obs, lat_obs)
+
+
+class ChebyshevEngine(Engine):
+    """
+      daily polynomial fit of the "full" engine, see sun.ChebyshevEphemeris
+    """
+    name = "chebyshev"
+    # the fit adds 6e-5 to the "full" error
+    maxerror = 0.011
+
+    def __init__(self, degree=6, maxfits=8):
+        self.ephemeris = sun.ChebyshevEphemeris(degree, maxfits)
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        return self.ephemeris.sun_az_alt_jd(jd, lon_obs, lat_obs)
+
+
+class TableEngine(Engine):
+    """
+      precomputed table of the "full" engine, see sun.EphemerisTable; its maximum
+      error adds the interpolation error of the table, which depends on the site.
+      Outside the table span the "full" engine is used
+    """
+    name = "table"
+
+    def __init__(self, filename):
+        self.table = sun.EphemerisTable(filename)
+        self.maxerror = FullEngine.maxerror + self.table.maxerror
+        self.fallback = FullEngine()
+        # warn once each time lookups leave the table span
+        self.outside = False
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        table = self.table
+        if table.jd0 <= jd <= table.jd1:
+            self.outside = False
+            return table.sun_az_alt_jd(jd, lon_obs, lat_obs)
+        if not self.outside:
+            self.outside = True
+            log.warn("%s out of table %s range [%s, %s], using the full engine" % (jd, table.filename, table.jd0,
+                                                                                 table.jd1))
+        return self.fallback.sun_az_alt_jd(jd, lon_obs, lat_obs)
+
+
+class SpaEngine(Engine):
+    """
+      NREL solar position algorithm, see spa.py
+    """
+    name = "spa"
+    tier = PRECISE
+    maxerror = 0.0
+
+    def __init__(self, elevation=0.0, delta_t=spa.DELTA_T):
+        self.elevation = elevation
+        self.delta_t = delta_t
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        return spa.sun_az_alt_jd(jd, lon_obs, lat_obs, self.elevation, self.delta_t)
+
+
+# engines, cheapest first
+ENGINES = (TableEngine, ChebyshevEngine, FullEngine, SpaEngine)
+
+
+def get_engine(name):
+    """
+      return an engine by name: full, chebyshev, spa or table:<file>
+    """
+    if name.startswith("table:"):
+        return TableEngine(name[len("table:"):])
+    for engine in ENGINES:
+        if engine.name == name and engine is not TableEngine:
+            return engine()
+    raise ValueError("unknown ephemeris engine [%s]" % name)
+
+
+def engine_for_tolerance(tolerance, tablefile=None):
+    """
+      return the cheapest engine whose maximum error is within tolerance (degrees);
+      the table engine is a candidate only if a table file is given
+    """
+    for engine in ENGINES:
+        if engine is TableEngine:
+            if tablefile is None:
+                continue
+            table = TableEngine(tablefile)
+            if table.maxerror <= tolerance:
+                return table
+            table.table.close()
+        elif engine.maxerror <= tolerance:
+            return engine()
+    raise ValueError("no ephemeris engine has an error within %f degrees" % tolerance)
+
+
+class SunStepper(object):
+    """
+      sun position for a tracking loop, advanced incrementally from anchors
+
+      At an anchor the engine position is converted to hour angle and declination;
+      the engine is also asked for the position 'interval' steps later, and between
+      the two anchors hour angle and declination change linearly. Both are kept as
+      (cos, sin) pairs and advanced with a fixed rotation per step, so step() needs
+      no trigonometry apart from the final atan2/asin. The end of an interval is the
+      next anchor: one engine call every 'interval' steps.
+
+      The deviation from the engine in the middle of an interval is estimated from
+      the change of rates between consecutive intervals; the interval is halved when
+      the estimate exceeds maxerror (degrees) and doubled, up to maxinterval, when it
+      is well below.
+    """
+
+    def __init__(self, lon_obs, lat_obs, jd, dt, engine=None, maxerror=0.001, maxinterval=600):
+        self.engine = engine if engine is not None else FullEngine()
+        self.lon = lon_obs
+        self.lat = lat_obs
+        self.dt = dt
+        self.stepdays = dt / 86400.0
+        self.maxerror = maxerror
+        self.maxinterval = maxinterval
+        self.interval = min(maxinterval, 16)
+        lat = math.radians(lat_obs)
+        self.sinlat = math.sin(lat)
+        self.coslat = math.cos(lat)
+        self.anchors = 0
+        self.errorbound = None
+        self.rates = None
+        self.anchor(jd)
+
+    def _equatorial(self, jd):
+        """return hour angle and declination (radians) from the engine position"""
+        az, alt = self.engine.sun_az_alt_jd(jd, self.lon, self.lat)
+        az = math.radians(az)
+        alt = math.radians(alt)
+        sinalt = math.sin(alt)
+        cosalt = math.cos(alt)
+        cosaz = math.cos(az)
+        dec = math.asin(self.sinlat * sinalt + self.coslat * cosalt * cosaz)
+        ha = math.atan2(-math.sin(az) * cosalt, self.coslat * sinalt - self.sinlat * cosalt * cosaz)
+        return (ha, dec)
+
+    def anchor(self, jd, start=None):
+        """
+          restart stepping from jd; start is the (hour angle, declination) at jd if already known
+        """
+        if start is None:
+            start = self._equatorial(jd)
+        self.anchors += 1
+        self.jd = jd
+        self.n = 0
+        self.start = start
+        interval = self.interval
+        self.jd1 = jd + interval * self.stepdays
+        self.end = self._equatorial(self.jd1)
+
+        ha0, dec0 = start
+        ha1, dec1 = self.end
+        dha = ((ha1 - ha0 + math.pi) % (2 * math.pi) - math.pi) / interval
+        ddec = (dec1 - dec0) / interval
+
+        if self.rates is not None:
+            # mid interval deviation of a quadratic path from its secant
+            oldinterval, olddha, oldddec = self.rates
+            self.errorbound = math.degrees(interval * (abs(dha - olddha) * math.cos(dec0) + abs(ddec - oldddec)) / 8.0)
+            if self.errorbound > self.maxerror and interval > 1:
+                # too far apart: redo with a shorter interval
+                self.interval //= 2
+                self.anchors -= 1
+                self.anchor(jd, start)
+                return
+            if self.errorbound < self.maxerror / 8.0:
+                self.interval = min(interval * 2, self.maxinterval)
+        self.rates = (interval, dha, ddec)
+
+        self.dha = dha
+        self.ddec = ddec
+        self.rotha = (math.cos(dha), math.sin(dha))
+        self.rotdec = (math.cos(ddec), math.sin(ddec))
+        self.cosha = math.cos(ha0)
+        self.sinha = math.sin(ha0)
+        self.cosdec = math.cos(dec0)
+        self.sindec = math.sin(dec0)
+
+    def step(self):
+        """
+          advance by dt and return azimuth and altitude of the sun
+        """
+        self.n += 1
+        if self.n >= self.rates[0]:
+            self.anchor(self.jd1, self.end)
+        else:
+            c, s = self.rotha
+            self.cosha, self.sinha = self.cosha * c - self.sinha * s, self.sinha * c + self.cosha * s
+            c, s = self.rotdec
+            self.cosdec, self.sindec = self.cosdec * c - self.sindec * s, self.sindec * c + self.cosdec * s
+        return self._horizontal(self.cosha, self.sinha, self.cosdec, self.sindec)
+
+    def position(self, jd):
+        """
+          return azimuth and altitude at any jd; inside the current interval
+          this costs two sin/cos pairs, elsewhere the stepper is anchored again at jd
+        """
+        k = (jd - self.jd) / self.stepdays
+        if k < 0 or k > self.rates[0]:
+            self.anchor(jd)
+            k = 0
+        ha = self.start[0] + k * self.dha
+        dec = self.start[1] + k * self.ddec
+        return self._horizontal(math.cos(ha), math.sin(ha), math.cos(dec), math.sin(dec))
+
+    def _horizontal(self, cosha, sinha, cosdec, sindec):
+        sinalt = sindec * self.sinlat + cosdec * self.coslat * cosha
+        a = -cosdec * self.coslat * sinha
+        b = sindec - self.sinlat * sinalt
+        az = math.degrees(math.atan2(a, b)) % 360.0
+        return (az, math.degrees(math.asin(max(-1.0, min(1.0, sinalt)))))
+
+
+if __name__ == "__main__":
+    import datetime
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    # sites from 60N to 34S, two of them between the tropics
+    SITES = ((9.19, 45.46), (24.9, 60.2), (150.0, -33.9), (0.0, 0.0), (-80.0, 23.4))
+
+    def angular_distance(a, b):
+        """angle in degrees between two (azimuth, altitude) directions"""
+        az1, alt1 = math.radians(a[0]), math.radians(a[1])
+        az2, alt2 = math.radians(b[0]), math.radians(b[1])
+        h = math.sin((alt2 - alt1) / 2) ** 2 + math.cos(alt1) * math.cos(alt2) * math.sin((az2 - az1) / 2) ** 2
+        return math.degrees(2 * math.asin(math.sqrt(min(1.0, h))))
+
+    class UnitTestEngines(unittest.TestCase):
+        def setUp(self):
+            self.precise = SpaEngine()
+            self.tmpdir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.tmpdir)
+
+        def maxerror(self, engine, lon, lat, samples):
+            return max(angular_distance(engine.sun_az_alt_jd(jd, lon, lat), self.precise.sun_az_alt_jd(jd, lon, lat))
+                       for jd in samples)
+
+        def table(self, lon, lat, year):
+            filename = os.path.join(self.tmpdir, "%f_%f.eph" % (lon, lat))
+            sun.write_ephemeris_table(filename, lon, lat, year, year)
+            return TableEngine(filename)
+
+        def testAbstract(self):
+            self.assertRaises(TypeError, Engine)
+
+        def testDeclaredErrors(self):
+            samples = []
+            for year in xrange(2000, 2051, 10):
+                jd0 = sun.cd_to_jd(datetime.date(year, 1, 1))
+                # 6 samples a day at shifting times
+                samples.extend(jd0 + d + (h * 4 + d % 4) / 24.0 + (d % 7) / 1440.0
+                               for d in xrange(0, 365, 6) for h in xrange(6))
+            for engine in (FullEngine(), ChebyshevEngine()):
+                for lon, lat in SITES:
+                    error = self.maxerror(engine, lon, lat, samples)
+                    self.assertLessEqual(error, engine.maxerror, "%s at [%f,%f]: %f" % (engine.name, lon, lat, error))
+            self.assertEqual(self.maxerror(self.precise, 0.0, 0.0, samples[:100]), 0.0)
+
+        def testTableError(self):
+            for lon, lat in (SITES[0], SITES[-1]):
+                engine = self.table(lon, lat, 2026)
+                # off the samples, and densely enough to catch the sun near the zenith
+                samples = [engine.table.jd0 + 0.0001 + i * 0.00607 for i in xrange(60000)]
+                full = FullEngine()
+                error = max(angular_distance(engine.sun_az_alt_jd(jd, lon, lat), full.sun_az_alt_jd(jd, lon, lat))
+                            for jd in samples)
+                self.assertLessEqual(error, engine.table.maxerror)
+                error = self.maxerror(engine, lon, lat, samples[::20])
+                self.assertLessEqual(error, engine.maxerror, "table at [%f,%f]: %f" % (lon, lat, error))
+                engine.table.close()
+
+        def testPastTableEnd(self):
+            lon, lat = SITES[0]
+            engine = self.table(lon, lat, 2026)
+            jd1 = engine.table.jd1
+            self.assertEqual(engine.sun_az_alt_jd(jd1, lon, lat), engine.table.sun_az_alt_jd(jd1, lon, lat))
+            self.assertFalse(engine.outside)
+            for jd in (jd1 + 1e-6, jd1 + 1.0, engine.table.jd0 - 1e-6):
+                self.assertEqual(engine.sun_az_alt_jd(jd, lon, lat), sun.sun_az_alt_jd(jd, lon, lat))
+                self.assertTrue(engine.outside)
+            engine.table.close()
+
+        def testEngineForTolerance(self):
+            self.assertIsInstance(engine_for_tolerance(0.02), ChebyshevEngine)
+            self.assertIsInstance(engine_for_tolerance(0.001), SpaEngine)
+            self.assertRaises(ValueError, engine_for_tolerance, -1)
+            temperate = self.table(SITES[0][0], SITES[0][1], 2026).table.filename
+            self.assertIsInstance(engine_for_tolerance(0.02, temperate), TableEngine)
+            tropical = self.table(SITES[-1][0], SITES[-1][1], 2026).table.filename
+            self.assertIsInstance(engine_for_tolerance(0.02, tropical), ChebyshevEngine)
+
+    ####################################################################
+    unittest.main()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# pigpiod stand-in
+#
+# Answers the pigpiod socket commands used by pulsecounter.py, runs scripts
+# with an interpreter for the commands COUNTSCRIPT needs, and simulates motors
+# whose pulse sensor toggles while their power gpio is on.
+#
+
+import sys
+import getopt
+import struct
+import threading
+import time
+import SocketServer
+
+import pulsecounter
+
+BAD_SCRIPT = -47
+BAD_SCRIPT_ID = -48
+
+# script commands: number of arguments
+OPCODES = {"ld": 2, "lda": 1, "sta": 1, "inr": 1, "cmp": 1, "tag": 1, "jmp": 1, "jz": 1, "jnz": 1, "jm": 1,
+           "r": 1, "w": 2, "tick": 0, "mics": 1}
+
+
+def signed(value):
+    value &= 0xffffffff
+    return value - (1 << 32) if value & 0x80000000 else value
+
+
+class Script(object):
+    def __init__(self, daemon, text):
+        tokens = text.split()
+        self.daemon = daemon
+        self.program = []
+        self.tags = {}
+        i = 0
+        while i < len(tokens):
+            op = tokens[i].lower()
+            if op not in OPCODES:
+                raise ValueError("unknown script command [%s]" % op)
+            args = tokens[i + 1:i + 1 + OPCODES[op]]
+            if op == "tag":
+                self.tags[int(args[0])] = len(self.program)
+            else:
+                self.program.append((op, args))
+            i += 1 + OPCODES[op]
+        self.params = [0] * 10
+        self.vars = [0] * 150
+        self.status = pulsecounter.SCRIPT_HALTED
+        self.thread = None
+        self.stopped = False
+
+    def value(self, arg):
+        if arg[0] == "p":
+            return self.params[int(arg[1:])]
+        if arg[0] == "v":
+            return self.vars[int(arg[1:])]
+        return int(arg)
+
+    def store(self, arg, value):
+        if arg[0] == "p":
+            self.params[int(arg[1:])] = value
+        else:
+            self.vars[int(arg[1:])] = value
+
+    def start(self, params):
+        self.stop()
+        self.params[:len(params)] = params
+        self.stopped = False
+        self.status = pulsecounter.SCRIPT_RUNNING
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped = True
+            self.thread.join()
+            self.thread = None
+        self.status = pulsecounter.SCRIPT_HALTED
+
+    def run(self):
+        a = f = 0
+        pc = 0
+        daemon = self.daemon
+        while pc < len(self.program) and not self.stopped:
+            op, args = self.program[pc]
+            pc += 1
+            if op == "ld":
+                self.store(args[0], self.value(args[1]))
+            elif op == "lda":
+                a = f = self.value(args[0])
+            elif op == "sta":
+                self.store(args[0], a)
+            elif op == "inr":
+                self.store(args[0], self.value(args[0]) + 1)
+            elif op == "cmp":
+                f = a - self.value(args[0])
+            elif op == "jmp" or (op == "jz" and not f) or (op == "jnz" and f) or (op == "jm" and f < 0):
+                pc = self.tags[self.value(args[0])]
+            elif op == "r":
+                a = daemon.levels.get(self.value(args[0]), 0)
+            elif op == "w":
+                daemon.write(self.value(args[0]), self.value(args[1]))
+            elif op == "tick":
+                a = daemon.tick()
+            elif op == "mics":
+                time.sleep(self.value(args[0]) / 1e6)
+        self.status = pulsecounter.SCRIPT_HALTED
+
+
+class Motor(threading.Thread):
+    """
+      pulse sensor toggling at 'rate' pulses per second while the power gpio is 1,
+      and for 'coast' seconds after
+    """
+
+    def __init__(self, daemon, pulsegpio, powergpio, rate, coast):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pigpiod = daemon
+        self.pulseGpio = pulsegpio
+        self.powerGpio = powergpio
+        self.period = 1.0 / rate
+        self.coast = coast
+        self.running = True
+
+    def run(self):
+        levels = self.pigpiod.levels
+        tnext = time.time()
+        tstop = 0
+        while self.running:
+            tnext += self.period / 2
+            time.sleep(max(0.0, tnext - time.time()))
+            if levels.get(self.powerGpio):
+                tstop = time.time() + self.coast
+            elif time.time() >= tstop:
+                tnext = time.time()
+                continue
+            levels[self.pulseGpio] = levels.get(self.pulseGpio, 0) ^ 1
+
+
+class FakePigpiod(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=("localhost", 0)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, Handler)
+        self.levels = {}
+        self.scripts = {}
+        self.motors = []
+        self.start = time.time()
+
+    def tick(self):
+        return int((time.time() - self.start) * 1e6) & 0xffffffff
+
+    def write(self, gpio, level):
+        self.levels[gpio] = level
+
+    def addmotor(self, pulsegpio, powergpio, rate=100.0, coast=0.05):
+        motor = Motor(self, pulsegpio, powergpio, rate, coast)
+        self.motors.append(motor)
+        motor.start()
+        return motor
+
+    def command(self, cmd, p1, p2, ext):
+        """
+          result of a command, and the extension of the answer
+        """
+        if cmd == pulsecounter.CMD_READ:
+            return self.levels.get(p1, 0), ""
+        if cmd == pulsecounter.CMD_WRITE:
+            self.write(p1, p2)
+            return 0, ""
+        if cmd == pulsecounter.CMD_TICK:
+            return signed(self.tick()), ""
+        if cmd == pulsecounter.CMD_PROC:
+            try:
+                script = Script(self, ext)
+            except (ValueError, IndexError):
+                return BAD_SCRIPT, ""
+            sid = len(self.scripts)
+            self.scripts[sid] = script
+            return sid, ""
+        script = self.scripts.get(p1)
+        if script is None:
+            return BAD_SCRIPT_ID, ""
+        if cmd == pulsecounter.CMD_PROCR:
+            script.start(struct.unpack("%dI" % (len(ext) // 4), ext))
+        elif cmd == pulsecounter.CMD_PROCS:
+            script.stop()
+        elif cmd == pulsecounter.CMD_PROCD:
+            script.stop()
+            del self.scripts[p1]
+        elif cmd == pulsecounter.CMD_PROCP:
+            data = struct.pack("11i", script.status, *[signed(p) for p in script.params])
+            return len(data), data
+        return 0, ""
+
+    def shutdown(self):
+        for motor in self.motors:
+            motor.running = False
+        for script in self.scripts.values():
+            script.stop()
+        SocketServer.ThreadingTCPServer.shutdown(self)
+
+
+class Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.recvall(16)
+            if data is None:
+                return
+            cmd, p1, p2, p3 = struct.unpack("IIII", data)
+            ext = self.recvall(p3) if p3 else ""
+            res, extra = self.server.command(cmd, p1, p2, ext)
+            self.request.sendall(struct.pack("IIIi", cmd, p1, p2, res) + extra)
+
+    def recvall(self, n):
+        data = ""
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+def usage():
+    print "Usage : %s [-p,--port=<port, default 8888>] [-m,--motor=<pulse gpio>,<power gpio>[,<rate>[,<coast>]]]" % (
+        sys.argv[0])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    port = 8888
+    motors = []
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:m:", ["help", "port=", "motor="])
+    except getopt.GetoptError:
+        print "Error parsing argument:", sys.exc_info()[1]
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o in ("-p", "--port"):
+            port = int(a)
+        if o in ("-m", "--motor"):
+            motors.append([int(v) for v in a.split(",")[:2]] + [float(v) for v in a.split(",")[2:]])
+
+    server = FakePigpiod(("localhost", port))
+    for motor in motors:
+        server.addmotor(*motor)
+    print "fake pigpiod on port %d" % server.server_address[1]
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
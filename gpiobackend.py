@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+# gpio backends
+#
+# A backend drives the relays and reads the pulse sensors of the motors, see
+# LinearMotor.setbackend; every operation is timed into a latency histogram.
+#
+
+import math
+import time
+import heapq
+import random
+import logging
+import collections
+
+log = logging.getLogger("gpiobackend")
+
+
+class LatencyHistogram(object):
+    """
+      latencies in power of 2 microsecond buckets: bucket i counts latencies
+      below 2**i us and not below 2**(i-1) us
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.buckets[min(self.BUCKETS - 1, us.bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+          upper bound in us of the latency of the p percent fastest operations
+        """
+        n = 0
+        for i, count in enumerate(self.buckets):
+            n += count
+            if n and n >= self.count * p / 100.0:
+                return 1 << i
+        return 0
+
+    def summary(self):
+        if not self.count:
+            return "0 calls"
+        return "%d calls, mean %.1f us, p50 < %d us, p99 < %d us, max %.1f us" % (
+            self.count, self.total * 1e6 / self.count, self.percentile(50), self.percentile(99), self.max * 1e6)
+
+
+class Backend(object):
+    """
+      gpio backend interface: ports are P1 header pin numbers
+    """
+    name = None
+    # bank_write available, see linearmotor.GpioBank
+    BANK = False
+
+    def __init__(self):
+        self.latency = collections.defaultdict(LatencyHistogram)
+        # port -> bit of bank_write
+        self.bitmap = {}
+
+    def write(self, port, value, label=""):
+        t = time.time()
+        self._write(port, value, label)
+        self.latency["write"].add(time.time() - t)
+
+    def read(self, port):
+        t = time.time()
+        value = self._read(port)
+        self.latency["read"].add(time.time() - t)
+        return value
+
+    def bank_write(self, setmask, clearmask):
+        """
+          set and clear the gpios of the bits in setmask and clearmask at once
+        """
+        t = time.time()
+        self._bank_write(setmask, clearmask)
+        self.latency["bank_write"].add(time.time() - t)
+
+    def set_edgecallback(self, port, fn, label=""):
+        """
+          call fn(gpio, level, tick) on both edges of port, timing the calls
+        """
+        histogram = self.latency["callback"]
+
+        def timedfn(gpio=None, level=None, tick=None):
+            t = time.time()
+            fn(gpio, level, tick)
+            histogram.add(time.time() - t)
+
+        self._set_edgecallback(port, timedfn, label)
+
+    def cancel_callback(self, port, label=""):
+        self._cancel_callback(port, label)
+
+    def setup_motor(self, powerport, dirport, pulseport):
+        """
+          relays as outputs, pulse sensor as input with pull up
+        """
+        pass
+
+    def cleanup(self, powerports=()):
+        pass
+
+    def latencysummary(self):
+        return ["%s: %s" % (op, self.latency[op].summary()) for op in sorted(self.latency)]
+
+    def _write(self, port, value, label):
+        raise NotImplementedError
+
+    def _read(self, port):
+        raise NotImplementedError
+
+    def _bank_write(self, setmask, clearmask):
+        raise NotImplementedError
+
+    def _set_edgecallback(self, port, fn, label):
+        raise NotImplementedError
+
+    def _cancel_callback(self, port, label):
+        raise NotImplementedError
+
+
+class RPiGpioBackend(Backend):
+    """
+      RPi.GPIO: P1 header numbering, no bank writes
+    """
+    name = "GPIO"
+
+    def __init__(self):
+        Backend.__init__(self)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        # use P1 header pin numbering convention
+        GPIO.setmode(GPIO.BOARD)
+
+    def setup_motor(self, powerport, dirport, pulseport):
+        self.GPIO.setup(powerport, self.GPIO.OUT)
+        self.GPIO.setup(dirport, self.GPIO.OUT)
+        self.GPIO.setup(pulseport, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+
+    def cleanup(self, powerports=()):
+        for port in powerports:
+            self.GPIO.output(port, 0)
+        self.GPIO.cleanup()
+
+    def _write(self, port, value, label):
+        self.GPIO.output(port, value)
+        log.info("%s setted GPIO %d to %d" % (label, port, value))
+
+    def _read(self, port):
+        return self.GPIO.input(port)
+
+    def _set_edgecallback(self, port, fn, label):
+        log.info("%s set edge callback on port # %d" % (label, port))
+        self.GPIO.add_event_detect(port, self.GPIO.BOTH, callback=lambda channel: fn(channel), bouncetime=2)
+
+    def _cancel_callback(self, port, label):
+        log.info("%s cancel callback fn for port : # %d" % (label, port))
+        self.GPIO.remove_event_detect(port)
+
+
+class PigpioBackend(Backend):
+    """
+      pigpio: ports are mapped to Broadcom numbers by bitmap; relays of several
+      motors are switched with one set_bank_1/clear_bank_1 pair
+    """
+    name = "pigpio"
+    BANK = True
+
+    def __init__(self, bitmap, host="localhost", port=8888):
+        Backend.__init__(self)
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi(host, port)
+        self.bitmap = bitmap
+        self.callbacks = {}
+
+    def setup_motor(self, powerport, dirport, pulseport):
+        self.pi.set_mode(self.bitmap[powerport], self.pigpio.OUTPUT)
+        self.pi.set_mode(self.bitmap[dirport], self.pigpio.OUTPUT)
+        self.pi.set_mode(self.bitmap[pulseport], self.pigpio.INPUT)
+        self.pi.set_pull_up_down(self.bitmap[pulseport], self.pigpio.PUD_UP)
+
+    def cleanup(self, powerports=()):
+        self.pi.stop()
+
+    def _write(self, port, value, label):
+        # ALL gpios are identified by their Broadcom number
+        self.pi.write(self.bitmap[port], value)
+
+    def _read(self, port):
+        return self.pi.read(self.bitmap[port])
+
+    def _bank_write(self, setmask, clearmask):
+        if setmask:
+            self.pi.set_bank_1(setmask)
+        if clearmask:
+            self.pi.clear_bank_1(clearmask)
+
+    def _set_edgecallback(self, port, fn, label):
+        log.info("%s set edge callback fn for port # %d" % (label, port))
+        if port in self.callbacks:
+            self.callbacks[port].cancel()
+        self.callbacks[port] = self.pi.callback(self.bitmap[port], self.pigpio.EITHER_EDGE, fn)
+
+    def _cancel_callback(self, port, label):
+        log.info("%s cancel callback on port # %d" % (label, port))
+        if port in self.callbacks:
+            self.callbacks.pop(port).cancel()
+
+
+class SimulatedBackend(Backend):
+    """
+      logs the writes, reads 0, never calls back
+    """
+    name = "simulation"
+    BANK = True
+
+    def __init__(self, bitmap=None):
+        Backend.__init__(self)
+        self.bitmap = bitmap if bitmap is not None else {}
+
+    def _write(self, port, value, label):
+        log.info("%s simulate setting GPIO %d to %d" % (label, port, value))
+
+    def _read(self, port):
+        log.info("simulated read GPIO # %d" % port)
+        return 0
+
+    def _bank_write(self, setmask, clearmask):
+        log.info("simulate bank write set 0x%08x clear 0x%08x" % (setmask, clearmask))
+
+    def _set_edgecallback(self, port, fn, label):
+        log.info("%s simulated set edge callback fn on port # %d" % (label, port))
+
+    def _cancel_callback(self, port, label):
+        log.info("%s simulated cancel callback for port # %d" % (label, port))
+
+
+class VirtualActuator(object):
+    """
+      actuator of FakeBackend: 'rate' pulses/s forward and 'reverserate' backward,
+      reached 'spinup' s after power on and lost 'coast' s after power off (linear
+      ramps); 'pos' pulses from its end stop, at most 'travel'; a pulse bounces
+      (one more edge pair) with probability 'glitch'
+    """
+
+    def __init__(self, powerport, dirport, pulseport, rate=100.0, reverserate=None, spinup=0.0, coast=0.05,
+                 travel=2000, pos=0, glitch=0.0, seed=0):
+        self.powerPort = powerport
+        self.dirPort = dirport
+        self.pulsePort = pulseport
+        self.rate = {1: rate, -1: reverserate if reverserate else rate}
+        self.spinup = spinup
+        self.coast = coast
+        self.travel = travel
+        self.pos = pos
+        self.glitch = glitch
+        self.random = random.Random(seed)
+        self.bounces = 0
+        # (start, stop) in virtual s and pulses of the last runs
+        self.moves = collections.deque(maxlen=10000)
+        self.running = False
+
+    def nextpulse(self, v, step, powered):
+        """
+          time to the next pulse from speed v (pulses/s) and the speed then,
+          (None, 0) if the motor stops before
+        """
+        rate = self.rate[step]
+        if powered:
+            if not self.spinup or v >= rate:
+                return 1.0 / rate, rate
+            a = rate / self.spinup
+            # pulses to full speed
+            s = (rate * rate - v * v) / (2 * a)
+            if s >= 1:
+                v1 = math.sqrt(v * v + 2 * a)
+                return (v1 - v) / a, v1
+            return (rate - v) / a + (1 - s) / rate, rate
+        if not self.coast or v <= 0:
+            return None, 0.0
+        d = rate / self.coast
+        if v * v < 2 * d:
+            return None, 0.0
+        v1 = math.sqrt(v * v - 2 * d)
+        return (v - v1) / d, v1
+
+
+class FakeBackend(SimulatedBackend):
+    """
+      in process virtual actuators: when power relays go on, the motors pulse
+      synchronously, with ticks of a virtual clock, until the power goes off (from
+      the edge callback) and they coast to a stop, or an end stop is hit.
+      speedup 0 runs in virtual time: the clock only advances with the pulses and
+      advance(), so a day of moves takes seconds; speedup 1 paces the pulses in
+      real time
+    """
+    name = "fake"
+    # seconds between the edges of a bounce
+    BOUNCE = 50e-6
+
+    def __init__(self, bitmap=None, speedup=0):
+        SimulatedBackend.__init__(self, bitmap)
+        self.levels = {}
+        self.callbacks = {}
+        self.motors = {}
+        self.speedup = speedup
+        # virtual clock in s
+        self.now = 0.0
+        self.wallStart = time.time()
+
+    def addmotor(self, powerport, dirport, pulseport, **params):
+        motor = VirtualActuator(powerport, dirport, pulseport, **params)
+        self.motors[powerport] = motor
+        return motor
+
+    def tick(self):
+        return int(round(self.now * 1e6)) & 0xffffffff
+
+    def advance(self, seconds):
+        """
+          let time pass between moves in virtual time
+        """
+        self.now += seconds
+
+    def _write(self, port, value, label):
+        SimulatedBackend._write(self, port, value, label)
+        self.levels[port] = value
+        if value and port in self.motors:
+            self.run([self.motors[port]])
+
+    def _read(self, port):
+        return self.levels.get(port, 0)
+
+    def _bank_write(self, setmask, clearmask):
+        SimulatedBackend._bank_write(self, setmask, clearmask)
+        bits = dict((bit, port) for port, bit in self.bitmap.items())
+        for bit in xrange(32):
+            if (setmask | clearmask) & (1 << bit):
+                self.levels[bits.get(bit, bit)] = 1 if setmask & (1 << bit) else 0
+        self.run([self.motors[bits.get(bit, bit)] for bit in xrange(32)
+                  if setmask & (1 << bit) and bits.get(bit, bit) in self.motors])
+
+    def _set_edgecallback(self, port, fn, label):
+        self.callbacks[port] = fn
+
+    def _cancel_callback(self, port, label):
+        self.callbacks.pop(port, None)
+
+    def run(self, motors):
+        """
+          run the motors together, edge after edge in virtual time order
+        """
+        motors = [m for m in motors if not m.running]
+        if self.speedup:
+            self.now = max(self.now, (time.time() - self.wallStart) * self.speedup)
+        pending = []
+        for i, motor in enumerate(motors):
+            motor.running = True
+            motion = self.motion(motor)
+            t = next(motion, None)
+            if t is not None:
+                heapq.heappush(pending, (t, i, motion))
+        while pending:
+            t, i, motion = heapq.heappop(pending)
+            self.now = max(self.now, t)
+            if self.speedup:
+                delay = self.wallStart + self.now / self.speedup - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            t = next(motion, None)
+            if t is not None:
+                heapq.heappush(pending, (t, i, motion))
+
+    def motion(self, motor):
+        """
+          generator of one run: yields the virtual time of the next edge, makes it
+          when resumed
+        """
+        step = 1 if self.levels.get(motor.dirPort) else -1
+        start = self.now
+        pulses = 0
+        v = 0.0
+        while 0 <= motor.pos + step <= motor.travel:
+            dt, v = motor.nextpulse(v, step, self.levels.get(motor.powerPort))
+            if dt is None:
+                break
+            t = self.now
+            for i in (1, 2):
+                yield t + dt * i / 2
+                self.edge(motor, step)
+            pulses += 1
+        motor.moves.append((start, self.now, pulses))
+        motor.running = False
+
+    def edge(self, motor, step):
+        # the pulse counts on the rising edge forward, on the falling edge backward
+        counted = 1 if step > 0 else 0
+        level = self.levels.get(motor.pulsePort, 0) ^ 1
+        if level == counted:
+            motor.pos += step
+        self.toggle(motor.pulsePort, level)
+        if level == counted and motor.glitch and motor.random.random() < motor.glitch:
+            motor.bounces += 1
+            for level in (level ^ 1, level):
+                self.now += self.BOUNCE
+                self.toggle(motor.pulsePort, level)
+
+    def toggle(self, port, level):
+        self.levels[port] = level
+        fn = self.callbacks.get(port)
+        if fn is not None:
+            fn(port, level, self.tick())
+
+
+if __name__ == "__main__":
+    import unittest
+    import linearmotor
+
+    linearmotor.log = logging.getLogger("linearmotor")
+
+    class UnitTestGpioBank(unittest.TestCase):
+        def setUp(self):
+            self.writes = []
+            self.bank = linearmotor.GpioBank(lambda port, value, label="": self.writes.append((port, value)),
+                                             lambda setmask, clearmask: self.writes.append((setmask, clearmask)),
+                                             {19: 10, 21: 9, 15: 22})
+
+        def testBankWrite(self):
+            with self.bank:
+                self.bank.out(21, 1)
+                self.bank.out(19, 1)
+                self.bank.out(15, 0)
+            self.assertEqual(self.writes, [((1 << 9) | (1 << 10), 1 << 22)])
+
+        def testNoPowerOnWhenRaising(self):
+            pitch = linearmotor.LinearMotor("[pitch]", dirport=21, powerport=19, pulseport=3, pulsestep=0.522,
+                                            ab=225, bc=355, cd=40, d=-5, offset=136, hookoffset=34)
+            self.bank.attach(pitch)
+            pitch.wait = 0
+            pitch.pos = 100
+            try:
+                with self.bank:
+                    pitch.forward()
+                    pitch.settarget(200)
+                    pitch.on()
+                    raise IOError("pigpiod connection closed")
+            except IOError:
+                pass
+            self.assertEqual(self.writes, [])
+            self.assertEqual(pitch.power, 0)
+            self.assertIsNone(pitch.target)
+            self.assertIsNone(pitch.relayDir)
+            with self.assertRaises(IOError):
+                with self.bank:
+                    self.bank.out(19, 1)
+                    self.bank.out(15, 0)
+                    raise IOError("pigpiod connection closed")
+            self.assertEqual(self.writes, [(15, 0)])
+
+    class UnitTestFakeBackend(unittest.TestCase):
+        def setUp(self):
+            self.backend = FakeBackend({19: 10, 21: 9, 15: 22, 16: 23})
+            self.ticks = []
+
+        def cutafter(self, actuator, pulses):
+            """edge callback switching the power off after 'pulses' counted pulses"""
+            start = actuator.pos
+
+            def fn(port, level, tick):
+                self.ticks.append(tick)
+                if abs(actuator.pos - start) >= pulses:
+                    self.backend.write(actuator.powerPort, 0)
+
+            self.backend.set_edgecallback(actuator.pulsePort, fn)
+
+        def testFullSpeed(self):
+            actuator = self.backend.addmotor(19, 21, 3, rate=100.0, coast=0)
+            self.cutafter(actuator, 10)
+            self.backend.write(21, 1)
+            self.backend.write(19, 1)
+            self.assertEqual(actuator.pos, 10)
+            self.assertEqual(len(self.ticks), 20)
+            self.assertAlmostEqual(self.backend.now, 0.1)
+            self.assertEqual(self.ticks[-1], 100000)
+            self.assertEqual(actuator.moves[-1][2], 10)
+
+        def testSpinupAndCoast(self):
+            actuator = self.backend.addmotor(19, 21, 3, rate=100.0, spinup=0.1, coast=0.1)
+            self.cutafter(actuator, 20)
+            self.backend.write(21, 1)
+            self.backend.write(19, 1)
+            # from rest at 1000 pulses/s^2: the first pulse after sqrt(2 / 1000) s
+            self.assertEqual(self.ticks[1], int(round(math.sqrt(2 / 1000.0) * 1e6)))
+            # from 100 pulses/s, 0.1 s of coast are 5 pulses
+            self.assertEqual(actuator.pos, 25)
+            start, stop, pulses = actuator.moves[-1]
+            self.assertEqual(pulses, 25)
+            # 0.1 s spin-up for 5 pulses, 15 pulses at full speed, 0.1 s coast
+            self.assertAlmostEqual(stop - start, 0.35)
+
+        def testReverseRateAndEndStop(self):
+            actuator = self.backend.addmotor(19, 21, 3, rate=100.0, reverserate=50.0, coast=0, pos=5)
+            self.backend.write(21, 0)
+            self.backend.write(19, 1)
+            # stopped at the end stop with the power still on
+            self.assertEqual(actuator.pos, 0)
+            self.assertAlmostEqual(self.backend.now, 0.1)
+            self.assertFalse(actuator.running)
+
+        def testTogether(self):
+            pitch = self.backend.addmotor(19, 21, 3, rate=100.0, coast=0)
+            roll = self.backend.addmotor(15, 16, 5, rate=50.0, coast=0)
+            self.cutafter(pitch, 10)
+            rollticks = []
+
+            def fn(port, level, tick):
+                rollticks.append(tick)
+                if roll.pos >= 10:
+                    self.backend.write(15, 0)
+
+            self.backend.set_edgecallback(5, fn)
+            self.backend.bank_write((1 << 10) | (1 << 9) | (1 << 22) | (1 << 23), 0)
+            self.assertEqual((pitch.pos, roll.pos), (10, 10))
+            # the slower motor finishes last, the edges of both run in virtual time order
+            self.assertAlmostEqual(self.backend.now, 0.2)
+            self.assertLess(self.ticks[-1], rollticks[-1])
+            self.assertLess(rollticks[0], self.ticks[2])
+
+        def testVirtualTime(self):
+            actuator = self.backend.addmotor(19, 21, 3, rate=100.0, coast=0)
+            self.backend.advance(3600)
+            t = time.time()
+            self.cutafter(actuator, 1000)
+            self.backend.write(21, 1)
+            self.backend.write(19, 1)
+            self.assertAlmostEqual(self.backend.now, 3610)
+            self.assertEqual(actuator.moves[-1][:2], (3600, self.backend.now))
+            self.assertLess(time.time() - t, 1.0)
+
+        def testBounces(self):
+            counts = []
+            for i in (0, 1):
+                backend = FakeBackend()
+                actuator = backend.addmotor(19, 21, 3, coast=0, travel=100, glitch=0.1, seed=3)
+                edges = []
+                backend.set_edgecallback(3, lambda port, level, tick: edges.append(level))
+                backend.write(21, 1)
+                backend.write(19, 1)
+                counts.append((actuator.bounces, len(edges)))
+            # seeded: the same bounces every run, each one edge pair more than the pulses
+            self.assertEqual(counts[0], counts[1])
+            self.assertGreater(counts[0][0], 0)
+            self.assertEqual(counts[0][1], 2 * (100 + counts[0][0]))
+
+        def testMotorMoves(self):
+            actuator = self.backend.addmotor(19, 21, 3, rate=100.0, spinup=0.1, coast=0.1)
+            motor = linearmotor.LinearMotor("[pitch]", dirport=21, powerport=19, pulseport=3, pulsestep=0.522,
+                                            ab=225, bc=355, cd=40, d=-5, offset=136, hookoffset=34)
+            motor.setbackend(self.backend)
+            motor.wait = 0
+            motor.settleQuiet = 0
+            motor.pos = 0
+            for target in (100, 300, 150, 400, 200, 350):
+                motor.gopos(target)
+                self.assertEqual(motor.pos, actuator.pos)
+            # the coast is learned after the first move in each direction (moves 0 and 2)
+            self.assertLessEqual(max(abs(e) for e in list(motor.finalErrors)[3:]), 1)
+
+    unittest.main()
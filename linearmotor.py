@@ -4,8 +4,18 @@
 
 import math
 import time
+import array
+import pickle
+import bisect
+import collections
+import threading
 import logging.handlers
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 def gpio_out(port, value, label=""):
     # import RPi.GPIO as GPIO
@@ -21,7 +31,202 @@ def rad2deg(rad):
     return 180 * rad / math.pi
 
 
-class LinearMotor:
+class GpioBank(object):
+    """
+      gpio out function (see LinearMotor.set_gpioout) grouping writes: inside
+      "with bank:" the writes of that thread are collected and issued on exit as
+      one bankwrite(setmask, clearmask), with bit numbers from bitmap (port -> bit);
+      other writes, or all of them without bankwrite, go to gpioout one by one.
+      When the block raises, only the writes to 0 are issued, and the motors
+      attached to the ports of the dropped writes are told (LinearMotor.dropwrite)
+    """
+
+    def __init__(self, gpioout, bankwrite=None, bitmap=None):
+        self.gpioOut = gpioout
+        self.bankWrite = bankwrite
+        self.bitmap = bitmap if bitmap is not None else {}
+        self.owner = None
+        self.pending = None
+        # port -> motor writing it, see attach
+        self.motors = {}
+        # calls to gpioout and bankwrite
+        self.writes = 0
+
+    def attach(self, motor):
+        """
+          make motor write its relays through the bank
+        """
+        motor.set_gpioout(self.out)
+        self.motors[motor.dirPort] = motor
+        self.motors[motor.powerPort] = motor
+
+    def __enter__(self):
+        self.pending = collections.OrderedDict()
+        self.owner = threading.current_thread()
+        return self
+
+    def __exit__(self, *exc):
+        pending = self.pending
+        self.owner = None
+        self.pending = None
+        if exc[0] is not None:
+            # leaving on an error: switch off what was queued off, switch nothing on
+            dropped = [port for port, (value, label) in pending.items() if value]
+            pending = collections.OrderedDict((port, v) for port, v in pending.items() if not v[0])
+            for port in dropped:
+                if port in self.motors:
+                    self.motors[port].dropwrite(port)
+        if self.bankWrite is None or len(pending) < 2:
+            for port, (value, label) in pending.items():
+                self.out(port, value, label)
+            return
+        setmask = clearmask = 0
+        for port, (value, label) in pending.items():
+            if value:
+                setmask |= 1 << self.bitmap.get(port, port)
+            else:
+                clearmask |= 1 << self.bitmap.get(port, port)
+        self.bankWrite(setmask, clearmask)
+        self.writes += 1
+
+    def out(self, port, value, label=""):
+        if self.owner is threading.current_thread():
+            self.pending[port] = (value, label)
+        else:
+            self.gpioOut(port, value, label=label)
+            self.writes += 1
+
+
+def waittargets(motors, notify, stalltime=.5):
+    """
+      wait until the motors reach their target (see LinearMotor.settarget with notify),
+      consuming their pulse edges when woken up; a motor whose position does not change in stalltime seconds is stopped
+    """
+    # motors still moving, with their position at the start of the stall window
+    moving = [(m, m.pos) for m in motors]
+    # motors counting pulses in pigpiod, or stopped by polling, are polled
+    poll = min([m.pollInterval or m.stopPoll for m in motors if m.pollInterval or m.stopPoll] or [stalltime])
+    tstall = time.time() + stalltime
+    while moving:
+        notify.wait(max(0.0, min(tstall - time.time(), poll)))
+        notify.clear()
+        check = time.time() >= tstall
+        still = []
+        for m, opp in moving:
+            m.consume()
+            if m.targetEvent.is_set():
+                continue
+            if check:
+                if m.pos == opp:
+                    log.warn("%s stalled at pos %d, target %s" % (m.name, m.pos, m.target))
+                    m.canceltarget()
+                    m.targetEvent.set()
+                    continue
+                opp = m.pos
+            still.append((m, opp))
+        moving = still
+        if check:
+            tstall = time.time() + stalltime
+
+
+def waitendstops(motors, timeout=120):
+    """
+      wait until the motors (started by LinearMotor.startcalibration) reach their end
+      stop: no pulse for calibrateStall expected pulse periods, or calibratePoll
+      seconds if set; each motor is stopped on its own
+    """
+    endtime = time.time() + timeout  # max seconds for calibration
+    # position, time it was reached and stall limit of the motors still running
+    running = dict((m, [m.pos, time.time(), m.calibratePoll or m.CALIBRATESTART]) for m in motors)
+    while running and time.time() < endtime:
+        time.sleep(min(min(r[2] for r in running.values()) / 4, .1))
+        now = time.time()
+        for m, r in running.items():
+            pos = m.pos
+            if pos != r[0]:
+                speed = m.pulsespeed() or m.speed[-1]
+                r[:] = [pos, now, m.calibratePoll or (m.calibrateStall / speed if speed else r[2])]
+            elif now - r[1] > r[2]:
+                # no coasting at the end stop
+                m.off()
+                del running[m]
+    for m in running:
+        log.warn("%s no end stop in %d seconds" % (m.name, timeout))
+        m.off()
+
+
+def saveevents(filename, events):
+    """
+      save events recorded by LinearMotor.startrecording
+    """
+    with open(filename, "wb") as f:
+        pickle.dump([a.tostring() for a in events], f, 2)
+
+
+def loadevents(filename):
+    with open(filename, "rb") as f:
+        data = pickle.load(f)
+    events = LinearMotor.newrecording()
+    for a, raw in zip(events, data):
+        a.fromstring(raw)
+    return events
+
+
+def replayevents(motor, events):
+    """
+      feed recorded events to a motor, as the pulse callback and the relays would
+      have: pos, pulse speed and glitch counts are derived as they were on line
+    """
+    for tick, level, step, expected in zip(*events):
+        motor.step = step
+        motor.power = expected
+        motor.edgepulse(level=level, tick=tick)
+        motor.consume()
+    return motor
+
+
+def _geometryfield(index):
+    """
+      attribute of LinearMotor stored in its geometry tuple: assigning it drops the
+      angle2pos cache
+    """
+
+    def get(self):
+        return self._geometry[index]
+
+    def set(self, value):
+        geometry = list(self._geometry)
+        geometry[index] = value
+        self._geometry = tuple(geometry)
+        if self.cache is not None:
+            self.cache.clear()
+            self.cacheUsed.clear()
+
+    return property(get, set)
+
+
+class LinearMotor(object):
+    # pos2angle table: angle step, and angle range for motors without one
+    ANGLETABLESTEP = 0.1
+    ANGLETABLERANGE = (-80.0, 80.0)
+    # pulse timestamps kept, pulses used for the speed estimate
+    TICKS = 32
+    SPEEDPULSES = 8
+    # weight of a move in the learned speed and coast averages
+    LEARNRATE = 0.25
+    # pulse sensor edges kept until consume() processes them (a power of 2)
+    RING = 4096
+    # no target: the callback never wakes anybody
+    NOWAKE = float("inf")
+    # calibration: end stop after this many expected pulse periods without a pulse,
+    # or this many seconds without any pulse after power on
+    CALIBRATESTALL = 4.0
+    CALIBRATESTART = 1.0
+
+    # everything angle2pos depends on, see geometry
+    GEOMETRY = ("ab", "bc", "cd", "d", "offset", "hookoffset", "pulseStep", "b1", "hookdeg")
+    ab, bc, cd, d, offset, hookoffset, pulseStep, b1, hookdeg = [_geometryfield(i) for i in xrange(len(GEOMETRY))]
+
     def set_gpioout(self, gpioout):
         self.gpioOut = gpioout
 
@@ -38,11 +243,41 @@ class LinearMotor:
     def set_cancelpulsecallbackfn(self, cancelcallback):
         self.cancelPulseCallbackFn = cancelcallback
 
+    def setbackend(self, backend):
+        """
+          use a gpiobackend.Backend for the relays and the pulse sensor
+        """
+        self.set_gpioout(backend.write)
+        self.set_gpioin(backend.read)
+        self.set_cancelpulsecallbackfn(backend.cancel_callback)
+        self.set_edgepulsecallbackfn(backend.set_edgecallback)
+
+    def setpulsecounter(self, counter):
+        """
+          count pulses with a pulsecounter.PulseCounter instead of edgepulse: the
+          power is cut on target by pigpiod, consume reads the counts
+        """
+        if self.cancelPulseCallbackFn is not None:
+            self.cancelPulseCallbackFn(self.pulsePort, label=self.name)
+        self.counter = counter
+        self.pollInterval = counter.POLL
+        counter.arm(1 if self.step > 0 else 0)
+
     def __init__(self, name, dirport, powerport, pulseport, pulsestep, ab, bc, cd, d, offset, hookoffset=0, minstep=20):
         self.name = name
         self.dirPort = dirport
         self.powerPort = powerport
         self.pulsePort = pulseport
+
+        # angle2pos cache, see setangle2poscache
+        self.cache = None
+        self.cacheUsed = set()
+        self.cacheResolution = None
+        self.cacheSize = 0
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+        self._geometry = (None,) * len(self.GEOMETRY)
         self.pulseStep = pulsestep  # mm per pulse
         self.ab = ab  # raggio
         self.bc = bc  # distanza centro rotazione - attacco motore
@@ -57,8 +292,19 @@ class LinearMotor:
         self.b1 = rad2deg(math.atan2(d, self.h))  # angolo tra bc e  la verticale
 
         self.step = 1
-        self.pos = 0
+        self._pos = 0
+        # direction relay (None = unknown) and time of its last change; it settles
+        # in 'wait' seconds, see settlerelay
+        self.relayDir = None
+        self.relayChanged = 0.0
+        # skip writes leaving the direction relay as it is; False writes (and waits
+        # for) it on every move, as before relay tracking, for comparisons
+        self.trackRelay = True
+        # pos set from outside (calibration, saved state), see calibrate
+        self.posKnown = False
         self.wait = .2
+        # no pulse for this long after a move: the motor has stopped, see settle
+        self.settleQuiet = .3
         self.power = 0
         self.minstep = minstep
 
@@ -70,6 +316,52 @@ class LinearMotor:
         self.minAngle = None
         self.maxAngle = None
 
+        self.angleTable = None
+
+        # target position of a move, see settarget
+        self.target = None
+        self.targetEvent = threading.Event()
+        self.notify = None
+
+        # pulse sensor edges: tick (us, wrapping at 32 bits) and level, written by
+        # edgepulse at index 'written' and processed by consume up to 'consumed'
+        self.eventTicks = array.array('L', [0]) * self.RING
+        self.eventLevels = array.array('b', [0]) * self.RING
+        self.written = 0
+        self.consumed = 0
+        # edgepulse calls consume when 'written' gets to wakeAt, see settarget
+        self.wakeAt = self.NOWAKE
+        self.lock = threading.RLock()
+        # counted edges while the power was off, edges lost to a full ring
+        self.glitches = 0
+        self.overruns = 0
+        # consumed events go here too while recording, see startrecording
+        self.recording = None
+        # pulses counted in pigpiod instead, see setpulsecounter
+        self.counter = None
+        self.pollInterval = None
+        # seconds between target checks when the power is not cut from edgepulse
+        # (as before edgepulse did, for comparisons), None to cut on the target edge
+        self.stopPoll = None
+        # end stop detection, and (time, duration, drift) of the last calibration
+        self.calibrateStall = self.CALIBRATESTALL
+        # fixed end stop window in seconds instead (as before end stop detection, for comparisons)
+        self.calibratePoll = None
+        self.lastCalibration = None
+
+        # timestamps of the counted pulses, ring buffer of TICKS entries
+        self.ticks = [0] * self.TICKS
+        self.tickCount = 0
+        self.moveTicks = 0
+        # learned per direction: speed in pulses/s, coast time in s (pulses after power off / speed)
+        self.speed = {1: None, -1: None}
+        self.coastTime = {1: None, -1: None}
+        self.learnRate = self.LEARNRATE
+        # pos, speed and target when the power was cut on target, until the motor settles
+        self.cut = None
+        # final position error of the last moves, pulses past the target
+        self.finalErrors = collections.deque(maxlen=100)
+
         log.info("LinearMotor %s created" % name)
 
     def setanglerange(self, minangle, maxangle):
@@ -79,6 +371,18 @@ class LinearMotor:
         self.minAngle = minangle
         self.maxAngle = maxangle
 
+    @property
+    def pos(self):
+        self.consume()
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        with self.lock:
+            self.consume()
+            self._pos = pos
+            self.posKnown = True
+
     def setinitialpos(self, pos):
         """
           set initial position
@@ -92,13 +396,29 @@ class LinearMotor:
            1  = forwards ( extension )
         """
         log.info("%s issued setDir %d" % (self.name, direction))
-        self.step = direction
+        # edges so far count in the old direction
+        with self.lock:
+            self.consume()
+            if self.counter is not None:
+                self.countpulses(*self.counter.arm(1 if direction > 0 else 0))
+            self.step = direction
+        if direction == self.relayDir and self.trackRelay:
+            return
         pval = 1
         if direction == -1:
             pval = 0
 
         self.gpioOut(self.dirPort, pval, label=self.name)  # dir
-        time.sleep(self.wait)
+        self.relayDir = direction
+        self.relayChanged = time.time()
+
+    def settlerelay(self):
+        """
+          wait until the direction relay has settled, 'wait' seconds after its last change
+        """
+        delay = self.relayChanged + self.wait - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
     def setpower(self, power):
         """
@@ -108,10 +428,17 @@ class LinearMotor:
         """
         # glitch management
         log.info("%s issued setPower %d" % (self.name, power))
-
-        self.gpioOut(self.powerPort, power, label=self.name)
-        # time.sleep (0.2)
-        self.power = power
+        if power:
+            self.settlerelay()
+            # pulses are expected from the write on
+            self.consume()
+            self.power = power
+            self.gpioOut(self.powerPort, power, label=self.name)
+        else:
+            self.gpioOut(self.powerPort, power, label=self.name)
+            # time.sleep (0.2)
+            self.consume()
+            self.power = power
 
     def backward(self):
         self.setdir(-1)
@@ -141,62 +468,299 @@ class LinearMotor:
         else:
             self.backward()
 
+        done = threading.Event()
+        self.settarget(newpos, done)
         self.on()
+        waittargets([self], done)
+        self.settle()
 
-        opp = -999
-        tx = time.time()
-        while True:
-            ty = time.time()
-            if ty - tx > .5:
-                tx = ty
-                if opp == self.pos:
-                    break
-                opp = self.pos
+        log.info("%s pos %d" % (self.name, self.pos))
 
-            # log.info( "%s pos %d" % (self.name,self.pos))
-            if self.step > 0:
-                # forward
-                if self.pos > newpos - 2:
-                    break
+    def settarget(self, target, notify=None):
+        """
+          consume cuts power when pos gets close enough to target for the motor to
+          coast onto it (see targetreached), then sets targetEvent and the optional
+          notify event; edgepulse calls consume only when it has to look at the edges
+          again, see setwake
+        """
+        with self.lock:
+            self.consume()
+            self.notify = notify
+            self.targetEvent.clear()
+            self.moveTicks = self.tickCount
+            self.cut = None
+            self.target = target
+            if self.counter is not None:
+                togo = (target - self._pos) * self.step - self.predictedcoast() - .5
+                self.countpulses(*self.counter.arm(1 if self.step > 0 else 0, max(1, int(togo) + 1)))
             else:
-                # backward
-                if self.pos < newpos + 2:
-                    break
+                self.setwake()
 
-            time.sleep(.1)
+    def setwake(self):
+        """
+          ask edgepulse for a wake up halfway to the pulse where the target is
+          reached: the estimate is refined on each wake up, down to every edge
+        """
+        if self.stopPoll:
+            # waittargets checks the target every stopPoll seconds
+            self.wakeAt = self.NOWAKE
+            return
+        togo = (self.target - self._pos) * self.step - self.predictedcoast() - .5
+        # 'togo' pulses are twice as many edges; wakeAt is an edge index
+        self.wakeAt = self.consumed + max(1, int(togo)) - 1
 
-        log.info("%s pos %d" % (self.name, self.pos))
+    def targetreached(self):
+        """
+          True when the pulses to go are no more than the motor is expected to coast
+        """
+        return (self.target - self._pos) * self.step < self.predictedcoast() + .5
+
+    def pulsespeed(self):
+        """
+          pulses per second over the last pulses of the current move, None if unknown
+        """
+        n = min(self.SPEEDPULSES, self.tickCount - self.moveTicks - 1, self.TICKS - 1)
+        if n < 1:
+            return None
+        last = self.ticks[(self.tickCount - 1) % self.TICKS]
+        first = self.ticks[(self.tickCount - 1 - n) % self.TICKS]
+        dt = (last - first) & 0xffffffff
+        if not dt:
+            return None
+        return n * 1e6 / dt
+
+    def predictedcoast(self):
+        """
+          pulses the motor will do after power off, at the current (or learned) speed
+        """
+        speed = self.pulsespeed()
+        if speed is None:
+            speed = self.speed[self.step]
+        if speed is None or self.coastTime[self.step] is None:
+            return 0.0
+        return speed * self.coastTime[self.step]
+
+    def settle(self, quiet=None, timeout=5.0):
+        """
+          wait for the pulses to stop after a move, then learn speed and coast time
+          from it if the power was cut on target
+        """
+        if quiet is None:
+            quiet = self.settleQuiet
+        tend = time.time() + timeout
+        last = None
+        while time.time() < tend:
+            self.consume()
+            if (self.written, self._pos) == last:
+                break
+            last = (self.written, self._pos)
+            time.sleep(quiet)
+        if self.cut is None:
+            return
+        cutpos, cutspeed, target, direction = self.cut[:4]
+        self.cut = None
+        coast = (self.pos - cutpos) * direction
+        error = (self.pos - target) * direction
+        self.finalErrors.append(error)
+        if cutspeed and self.learnRate:
+            # running averages, starting from the first move
+            k = self.learnRate
+            if self.speed[direction] is None:
+                self.speed[direction] = cutspeed
+                self.coastTime[direction] = float(coast) / cutspeed
+            self.speed[direction] += k * (cutspeed - self.speed[direction])
+            self.coastTime[direction] += k * (float(coast) / cutspeed - self.coastTime[direction])
+        log.info("%s final error %d pulses, coasted %d pulses from %s pulses/s" % (self.name, error, coast, cutspeed))
+
+    def finalerrorstats(self):
+        """
+          number of moves, mean and maximum absolute final error in pulses
+        """
+        n = len(self.finalErrors)
+        if not n:
+            return 0, 0.0, 0
+        return n, float(sum(self.finalErrors)) / n, max(abs(e) for e in self.finalErrors)
+
+    def getlearned(self):
+        """
+          learned motion parameters, to be saved with the position
+        """
+        return {"speed": dict(self.speed), "coastTime": dict(self.coastTime), "finalErrors": list(self.finalErrors)}
 
-        self.off()
+    def setlearned(self, learned):
+        self.speed.update(learned["speed"])
+        self.coastTime.update(learned["coastTime"])
+        self.finalErrors.extend(learned["finalErrors"])
+
+    def canceltarget(self):
+        """
+          forget the target and cut power
+        """
+        self.target = None
+        self.wakeAt = self.NOWAKE
+        if self.power:
+            self.off()
+
+    def dropwrite(self, port):
+        """
+          a write switching port on was never issued (see GpioBank): the power relay
+          stayed off, so forget power and target; the direction relay is unknown
+        """
+        if port == self.powerPort:
+            log.warn("%s power on dropped, target %s cancelled" % (self.name, self.target))
+            self.consume()
+            self.power = 0
+            self.target = None
+            self.wakeAt = self.NOWAKE
+        elif port == self.dirPort:
+            self.relayDir = None
+
+    def setangle2poscache(self, resolution, size=256):
+        """
+          cache angle2pos for angles quantized to resolution degrees, up to 'size'
+          entries: when full the oldest one is dropped, unless it was used since
+          it got in or was last spared (second chance, a cheap LRU); resolution
+          None disables the cache. Assigning a geometry field clears it
+        """
+        self.cache = None if resolution is None else collections.OrderedDict()
+        self.cacheUsed = set()
+        self.cacheResolution = resolution
+        self.cacheSize = size
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        if resolution is not None:
+            # largest change of position for a resolution step, over the usual angle range
+            slope = max(abs(self._angle2pos(a + 1) - self._angle2pos(a)) for a in xrange(-80, 80))
+            log.info("%s angle2pos cache: resolution %f degrees (%f pulses), %d entries" % (self.name, resolution,
+                                                                                          resolution * slope, size))
+            if resolution * slope >= 1:
+                log.warn("%s angle2pos cache resolution is not below one pulse" % self.name)
+
+    def geometry(self):
+        """everything angle2pos depends on, in GEOMETRY order"""
+        return self._geometry
 
     def angle2pos(self, angle):
-        anglein = angle
+        if self.cache is not None:
+            position = self._cachedangle2pos(angle)
+        else:
+            position = self._angle2pos(angle)
+        log.debug("%s - angle2pos - angle %f -> position: %f", self.name, angle, position)
+        return position
+
+    def _cachedangle2pos(self, angle):
+        cache = self.cache
+        key = int(round(angle / self.cacheResolution))
+        position = cache.get(key)
+        if position is not None:
+            # moving the entry to the end of the OrderedDict costs more than _angle2pos,
+            # just mark it and let eviction requeue it
+            self.cacheHits += 1
+            self.cacheUsed.add(key)
+            return position
+        self.cacheMisses += 1
+        if len(cache) >= self.cacheSize:
+            used = self.cacheUsed
+            oldest, value = cache.popitem(last=False)
+            while oldest in used:
+                used.discard(oldest)
+                cache[oldest] = value
+                oldest, value = cache.popitem(last=False)
+        position = self._angle2pos(key * self.cacheResolution)
+        cache[key] = position
+        return position
+
+    def _angle2pos(self, angle):
+        ab, bc, cd, d, offset, hookoffset, pulsestep, b1, hookdeg = self._geometry
         angle += 90
 
-        beta = angle - self.b1
-        beta -= self.hookdeg
+        beta = angle - b1
+        beta -= hookdeg
         # log.info ( "%s angle %f b1 %f hook %f offset-ed angle %f" % (self.name,angle,self.b1,self.hookdeg,beta))
 
         teta = 90
         beta = deg2rad(beta)
         teta = deg2rad(teta)
-        ac = (self.ab ** 2 + self.bc ** 2 - 2 * self.ab * self.bc * math.cos(beta)) ** .5
-        y2 = math.asin((self.ab * math.sin(beta)) / ac)
+        ac = (ab ** 2 + bc ** 2 - 2 * ab * bc * math.cos(beta)) ** .5
+        y2 = math.asin((ab * math.sin(beta)) / ac)
         a2 = deg2rad(180) - (beta + y2)
-        a1 = math.asin((self.cd * math.sin(teta)) / ac)
+        a1 = math.asin((cd * math.sin(teta)) / ac)
         a = a1 + a2
         y = deg2rad(360) - (a + beta + teta)
         y1 = y - y2
         ad = (ac * math.sin(y1)) / math.sin(teta)
-        px = ad - self.offset
+        px = ad - offset
 
         # log.info( "%s lato incognito %d (offset-ed %d), angolo su a %f, angolo su c %f" % (self.name,ad,px,rad2deg(a),rad2deg(y)))
 
-        position = px / self.pulseStep
+        position = px / pulsestep
         # log.info ( "%s for %f degree LX is %f (%f inches)" % (self.name,angle,px,px/25.4))
-        log.debug("%s - angle2pos - angle %f -> position: %f" % (self.name, anglein, position))
         return position
 
+    def pos2angle(self, pos):
+        """
+          angle for a position: interpolated in a table of angle2pos over the motor
+          angle range, Newton iterations on angle2pos outside of the table
+        """
+        key = (self.minAngle, self.maxAngle, self.geometry())
+        if self.angleTable is None or self.angleTable[0] != key:
+            self.buildangletable()
+        key, angles, positions = self.angleTable
+
+        i = bisect.bisect_right(positions, pos)
+        if 0 < i < len(positions):
+            f = (pos - positions[i - 1]) / (positions[i] - positions[i - 1])
+            return angles[i - 1] + f * (angles[i] - angles[i - 1])
+        return self.pos2angle_newton(pos, angles[0] if i == 0 else angles[-1])
+
+    def buildangletable(self):
+        """
+          table of angle2pos for pos2angle, limited to where positions grow with the angle
+        """
+        minangle = float(self.minAngle if self.minAngle is not None else self.ANGLETABLERANGE[0])
+        maxangle = float(self.maxAngle if self.maxAngle is not None else self.ANGLETABLERANGE[1])
+        n = max(1, int(math.ceil((maxangle - minangle) / self.ANGLETABLESTEP)))
+        angles = [minangle + (maxangle - minangle) * i / n for i in xrange(n + 1)]
+        positions = [self._angle2pos(angle) for angle in angles]
+        start = 0
+        for i in xrange(1, len(positions)):
+            if positions[i] <= positions[i - 1]:
+                start = i
+        if start:
+            log.warn("%s angle2pos not monotonic below %f: pos2angle table starts there" % (self.name, angles[start]))
+        self.angleTable = ((self.minAngle, self.maxAngle, self.geometry()), angles[start:], positions[start:])
+
+    def pos2angle_newton(self, pos, angle, maxiter=20):
+        """
+          solve angle2pos(angle) = pos by Newton iterations starting from angle
+        """
+        h = 1e-4
+        for i in xrange(maxiter):
+            err = self._angle2pos(angle) - pos
+            if abs(err) < 1e-6:
+                break
+            slope = (self._angle2pos(angle + h) - self._angle2pos(angle - h)) / (2 * h)
+            if not slope > 0:
+                break
+            angle -= max(-10.0, min(10.0, err / slope))
+        return angle
+
+    def angle2pos_array(self, angles):
+        """
+          angle2pos for an array of angles (numpy)
+        """
+        beta = np.radians(np.asarray(angles, dtype=float) + 90 - self.b1 - self.hookdeg)
+        teta = math.radians(90)
+        ac = np.sqrt(self.ab ** 2 + self.bc ** 2 - 2 * self.ab * self.bc * np.cos(beta))
+        y2 = np.arcsin((self.ab * np.sin(beta)) / ac)
+        a2 = math.pi - (beta + y2)
+        a1 = np.arcsin((self.cd * math.sin(teta)) / ac)
+        a = a1 + a2
+        y = 2 * math.pi - (a + beta + teta)
+        y1 = y - y2
+        ad = (ac * np.sin(y1)) / math.sin(teta)
+        return (ad - self.offset) / self.pulseStep
+
     def fixangle(self, angle):
         if self.minAngle is not None and angle < self.minAngle:
             angle = self.minAngle
@@ -206,6 +770,19 @@ class LinearMotor:
             log.warn("%s angle too high: clipped to %f" % (self.name, angle))
         return angle
 
+    def fixangle_array(self, angles):
+        """
+          fixangle for an array of angles (numpy), logs how many were clipped
+        """
+        angles = np.asarray(angles, dtype=float)
+        fixed = np.clip(angles,
+                        -np.inf if self.minAngle is None else self.minAngle,
+                        np.inf if self.maxAngle is None else self.maxAngle)
+        clipped = np.count_nonzero(fixed != angles)
+        if clipped:
+            log.warn("%s %d angles out of range [%s, %s]: clipped" % (self.name, clipped, self.minAngle, self.maxAngle))
+        return fixed
+
     def goangle(self, angle):
         log.info("%s going to angle %f" % (self.name, angle))
         angle = self.fixangle(angle)
@@ -213,41 +790,162 @@ class LinearMotor:
         self.gopos(position)
 
     def edgepulse(self, gpio=None, level=None, tick=None):
-
-        if not self.power:
-            log.warn("%s pulse occured when power was off" % (self.name) )
-            # return                          # glitch ?
-
+        """
+          pulse sensor callback: store the edge, consume() does the rest when
+          called from here near the target, or when pos is read
+        """
         if level is None:
-            level = self.gpioIn(self.pulsePort)
+            level = self.gpioIn(self.pulsePort) or 0
+        if tick is None:
+            tick = int(time.time() * 1e6) & 0xffffffff
+        i = self.written
+        self.eventTicks[i & (self.RING - 1)] = tick
+        self.eventLevels[i & (self.RING - 1)] = level
+        self.written = i + 1
+        if i >= self.wakeAt:
+            self.consume()
+
+    def consume(self):
+        """
+          process the edges stored by edgepulse: update pos, pulse ticks and glitch
+          count, and cut the power when the target is reached
+        """
+        with self.lock:
+            if self.counter is not None:
+                self.consumecounts()
+                return
+            start = self.consumed
+            written = self.written
+            if start == written:
+                return
+            if written - start > self.RING:
+                self.overruns += written - start - self.RING
+                log.warn("%s lost %d pulse edges" % (self.name, written - start - self.RING))
+                start = written - self.RING
+            # rising edge on forward = ++
+            # falling edge on backward = --
+            counting = 1 if self.step > 0 else 0
+            expected = 1 if self.power or self.cut is not None else 0
+            glitches = 0
+            reached = False
+            mask = self.RING - 1
+            for i in xrange(start, written):
+                level = self.eventLevels[i & mask]
+                if self.recording is not None:
+                    for a, v in zip(self.recording, (self.eventTicks[i & mask], level, self.step, expected)):
+                        a.append(v)
+                if level != counting:
+                    continue
+                self._pos += self.step
+                self.ticks[self.tickCount % self.TICKS] = self.eventTicks[i & mask]
+                self.tickCount += 1
+                if not expected:
+                    glitches += 1
+                if self.target is not None and self.targetreached():
+                    reached = True
+                    written = i + 1
+                    break
+            self.consumed = written
+            if glitches:
+                self.glitches += glitches
+                log.warn("%s %d pulses occured when power was off" % (self.name, glitches))
+            if reached:
+                self.cut = (self._pos, self.pulsespeed(), self.target, self.step, self.eventTicks[(written - 1) & mask])
+                # the remaining edges are consumed with the power off
+                self.canceltarget()
+                self.targetEvent.set()
+                if self.notify is not None:
+                    self.notify.set()
+            elif self.target is not None:
+                self.setwake()
+
+    def consumecounts(self):
+        """
+          consume for pulses counted in pigpiod
+        """
+        delta, tick, cut = self.counter.read()
+        self.countpulses(delta, tick)
+        if cut is not None and self.target is not None:
+            cutcount, cuttick = cut
+            self.cut = (self._pos - (self.counter.count - cutcount) * self.step, self.pulsespeed(), self.target,
+                        self.step, cuttick)
+            self.canceltarget()
+            self.targetEvent.set()
+            if self.notify is not None:
+                self.notify.set()
+
+    def countpulses(self, delta, tick):
+        """
+          add pulses counted in pigpiod, spreading their ticks evenly since the previous ones
+        """
+        if not delta:
+            return
+        if not self.power and self.cut is None:
+            self.glitches += delta
+            log.warn("%s %d pulses occured when power was off" % (self.name, delta))
+        self._pos += delta * self.step
+        first = tick
+        if self.tickCount > self.moveTicks:
+            first = self.ticks[(self.tickCount - 1) % self.TICKS]
+        span = (tick - first) & 0xffffffff
+        for k in xrange(1, delta + 1):
+            self.ticks[self.tickCount % self.TICKS] = (first + span * k // delta) & 0xffffffff
+            self.tickCount += 1
+
+    @staticmethod
+    def newrecording():
+        return array.array('L'), array.array('b'), array.array('b'), array.array('b')
+
+    def startrecording(self):
+        """
+          keep the consumed edges (tick, level, direction, and 1 if the power was on or
+          the motor coasting after a cut on target) for replayevents
+        """
+        with self.lock:
+            self.consume()
+            self.recording = self.newrecording()
 
-        # rising edge on forward = ++
-        # falling edge on backward = --
-        if level:
-            if self.step > 0:
-                self.pos += 1
-        else:
-            if self.step < 0:
-                self.pos -= 1
+    def stoprecording(self):
+        with self.lock:
+            self.consume()
+            events, self.recording = self.recording, None
+        return events
 
-    def calibrate(self):
+    def motionstats(self):
         """
-          goto "0" position
+          edges seen, counted pulses while the power was off, edges lost and pulse speed
         """
-        log.info("%s calibration" % (self.name))
+        self.consume()
+        return {"edges": self.written, "glitches": self.glitches, "overruns": self.overruns,
+                "speed": self.pulsespeed()}
+
+    def calibrate(self, timeout=120):
+        """
+          goto "0" position: run backward until no pulse comes for calibrateStall
+          expected pulse periods, see waitendstops and endcalibration
+        """
+        tstart = time.time()
         self.backward()
-        self.on()
-        opp = -999
+        self.startcalibration()
+        waitendstops([self], timeout)
+        return self.endcalibration(tstart)
 
-        endtime = time.time() + 120  # max seconds for calibration
-        while opp != self.pos and time.time() < endtime:
-            log.info("%s pos %d" % (self.name, self.pos))
-            opp = self.pos
-            time.sleep(.4)
+    def startcalibration(self):
+        log.info("%s calibration" % (self.name))
+        self.moveTicks = self.tickCount
+        self.on()
 
-        self.off()
-        time.sleep(.4)
+    def endcalibration(self, tstart):
+        """
+          set the end stop as "0" position; return the duration and the drift found
+          (the position at the end stop, None if the position was not known)
+        """
+        duration = time.time() - tstart
+        drift = self.pos if self.posKnown else None
         self.pos = 0
+        self.lastCalibration = (time.time(), duration, drift)
+        log.info("%s calibrated in %.1f s, drift %s pulses" % (self.name, duration, drift))
+        return duration, drift
 
 
 if __name__ == "__main__":
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# write a precomputed sun ephemeris table for a site
+#
+import sys, getopt
+import time
+from sun import write_ephemeris_table, EphemerisTable
+
+
+def usage():
+    print "Usage : %s --latitude=<latitude> --longitude=<longitude> --from=<year> [--to=<year, default from>] " \
+          "[-s,--step=<seconds, default 60>] [-o,--output=<file, default sun.eph>]" % (sys.argv[0])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    latitude = None
+    longitude = None
+    fromyear = None
+    toyear = None
+    step = 60
+    output = "sun.eph"
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:o:", ["help", "latitude=", "longitude=", "from=", "to=",
+                                                            "step=", "output="])
+    except getopt.GetoptError:
+        print "Error parsing argument:", sys.exc_info()[1]
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+        if o == "--latitude":
+            latitude = float(a)
+        if o == "--longitude":
+            longitude = float(a)
+        if o == "--from":
+            fromyear = int(a)
+        if o == "--to":
+            toyear = int(a)
+        if o in ("-s", "--step"):
+            step = int(a)
+        if o in ("-o", "--output"):
+            output = a
+
+    if latitude is None or longitude is None or fromyear is None:
+        usage()
+    if toyear is None:
+        toyear = fromyear
+
+    t = time.time()
+    write_ephemeris_table(output, longitude, latitude, fromyear, toyear, step)
+    table = EphemerisTable(output)
+    print "%s: site [%f,%f], %d samples every %d s, written in %.1f s" % (output, table.lat, table.lon, table.count,
+                                                                         table.step, time.time() - t)
+    table.close()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# pulse counting inside pigpiod
+#
+# A pigpiod script polls the pulse sensor of a motor, counts the pulses and,
+# when asked to, cuts the motor power after a number of pulses: the daemon keeps
+# counting when Python is busy, and Python only fetches the counts in batches.
+#
+# pigpiod is spoken to directly through its socket interface
+# (http://abyz.co.uk/rpi/pigpio/sif.html), see fakepigpiod.py for a stand-in.
+#
+
+import socket
+import struct
+import time
+
+# socket interface commands
+CMD_READ = 3
+CMD_WRITE = 4
+CMD_TICK = 16
+CMD_PROC = 38
+CMD_PROCD = 39
+CMD_PROCR = 40
+CMD_PROCS = 41
+CMD_PROCP = 45
+
+# script status
+SCRIPT_INITING = 0
+SCRIPT_HALTED = 1
+SCRIPT_RUNNING = 2
+SCRIPT_WAITING = 3
+SCRIPT_FAILED = 4
+
+# parameters:
+#   p0 pulse gpio, p1 level of a counted edge, p2 pulses before cutting the power
+#   (0 = never), p3 power gpio, p9 polling interval in us
+# results:
+#   p4 pulses, p5 tick of the last pulse, p6 edges, p7 tick of the power cut,
+#   p8 pulses at the power cut (0 = no cut)
+COUNTSCRIPT = " ".join("""
+ld p4 0 ld p5 0 ld p6 0 ld p7 0 ld p8 0
+r p0 sta v0
+tag 1
+mics p9
+r p0 cmp v0 jz 1
+sta v0 inr p6
+cmp p1 jnz 1
+inr p4 tick sta p5
+lda p2 cmp 0 jz 1
+lda p4 cmp p2 jm 1
+w p3 0 tick sta p7 lda p4 sta p8 ld p2 0
+jmp 1
+""".split())
+
+
+class PigpiodError(Exception):
+    pass
+
+
+class PigpiodClient(object):
+    """
+      the few pigpiod socket commands used here
+    """
+
+    def __init__(self, host="localhost", port=8888):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def command(self, cmd, p1=0, p2=0, ext=""):
+        """
+          send a command, return its (signed) result; errors are negative
+        """
+        return self.pipeline([(cmd, p1, p2, ext)])[0][0]
+
+    def pipeline(self, commands):
+        """
+          send (cmd, p1, p2, ext) commands at once, then read their results and the
+          data returned by CMD_PROCP: one round trip for all of them
+        """
+        self.sock.sendall("".join(struct.pack("IIII", cmd, p1, p2, len(ext)) + ext for cmd, p1, p2, ext in commands))
+        results = []
+        for cmd, p1, p2, ext in commands:
+            res = struct.unpack("12xi", self.recv(16))[0]
+            if res < 0:
+                raise PigpiodError("pigpiod command %d failed: %d" % (cmd, res))
+            results.append((res, self.recv(res) if cmd == CMD_PROCP else ""))
+        return results
+
+    def recv(self, n):
+        data = ""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise PigpiodError("pigpiod connection closed")
+            data += chunk
+        return data
+
+    def read(self, gpio):
+        return self.command(CMD_READ, gpio)
+
+    def write(self, gpio, level):
+        self.command(CMD_WRITE, gpio, level)
+
+    def tick(self):
+        return self.command(CMD_TICK) & 0xffffffff
+
+    def store_script(self, text):
+        return self.command(CMD_PROC, ext=text)
+
+    def run_script(self, sid, params):
+        self.command(CMD_PROCR, sid, ext=struct.pack("%dI" % len(params), *params))
+
+    def script_status(self, sid):
+        """
+          status and the 10 parameters of a script
+        """
+        return self.unpackstatus(self.pipeline([(CMD_PROCP, sid, 0, "")])[0][1])
+
+    @staticmethod
+    def unpackstatus(data):
+        values = struct.unpack("%di" % (len(data) // 4), data)
+        return values[0], values[1:]
+
+    def stop_script(self, sid):
+        self.command(CMD_PROCS, sid)
+
+    def delete_script(self, sid):
+        self.command(CMD_PROCD, sid)
+
+    def close(self):
+        self.sock.close()
+
+
+class PulseCounter(object):
+    """
+      pulses of a motor counted by COUNTSCRIPT, see LinearMotor.setpulsecounter
+    """
+    # polling interval of the script in us, and of the Python side in s
+    SCRIPTPOLL = 100
+    POLL = 0.05
+    # seconds for pigpiod to get the stored script ready
+    INITTIMEOUT = 5.0
+
+    def __init__(self, client, pulsegpio, powergpio):
+        self.client = client
+        self.pulseGpio = pulsegpio
+        self.powerGpio = powergpio
+        self.sid = client.store_script(COUNTSCRIPT)
+        tend = time.time() + self.INITTIMEOUT
+        while client.script_status(self.sid)[0] == SCRIPT_INITING:
+            if time.time() > tend:
+                client.delete_script(self.sid)
+                raise PigpiodError("pulse counting script not ready after %.1f s" % self.INITTIMEOUT)
+            time.sleep(self.POLL)
+        # pulses of the current run already returned by read
+        self.count = 0
+        self.running = False
+
+    def arm(self, level, stopafter=0):
+        """
+          restart counting edges to 'level', cutting the power after 'stopafter' pulses;
+          return the pulses and last tick of the previous run not read yet
+        """
+        params = (self.pulseGpio, level, stopafter, self.powerGpio, 0, 0, 0, 0, 0, self.SCRIPTPOLL)
+        run = (CMD_PROCR, self.sid, 0, struct.pack("10I", *params))
+        left = (0, 0)
+        if self.running:
+            # stop, last counts and restart in one round trip
+            results = self.client.pipeline([(CMD_PROCS, self.sid, 0, ""), (CMD_PROCP, self.sid, 0, ""), run])
+            left = self.counts(*self.client.unpackstatus(results[1][1]))[:2]
+        else:
+            self.client.pipeline([run])
+        self.running = True
+        self.count = 0
+        return left
+
+    def read(self):
+        """
+          pulses since the last read, tick of the last pulse, and
+          (pulses, tick) at the power cut or None
+        """
+        return self.counts(*self.client.script_status(self.sid))
+
+    def counts(self, status, p):
+        if status == SCRIPT_FAILED:
+            raise PigpiodError("pulse counting script failed")
+        delta = p[4] - self.count
+        self.count = p[4]
+        cut = (p[8], p[7] & 0xffffffff) if p[8] else None
+        return delta, p[5] & 0xffffffff, cut
+
+    def close(self):
+        if self.running:
+            self.client.stop_script(self.sid)
+        self.client.delete_script(self.sid)
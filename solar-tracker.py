@@ -5,7 +5,8 @@ import time
 import os
 import pickle
 import math
-from sun import sun_az_alt, sun_time
+from sun import almanac, jd_to_cd, cd_to_jd
+import ephemeris
 import datetime
 import socket
 # sudo apt-get install python-tz
@@ -26,11 +27,15 @@ ch.setLevel(logging.DEBUG)
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
+# table lookups past their span are reported here
+ephemeris.log = log
+
 
 def usage():
     print "Usage : %s [--latitude=<latitude> ] [--longitude=<longitude>] [--timezone=<timezone, default CET>] " \
           "[-s,--step=<step[s|m]>] [--motor-driver-address=<address[:port]>] [--timewarp=<factor>] [--simulate] " \
-          "[--startfrom=<dd/mm/YYYY-HH:MM>] " \
+          "[--startfrom=<dd/mm/YYYY-HH:MM>] [--ephemeris=<full|chebyshev|spa|table:<file>|auto, default full>] " \
+          "[--tolerance=<degrees, for auto, default 0.05>] [--table=<file, for auto>] " \
           "[--calibrateon=<list of comma separated weekday to perform calibration(0=Monday), default 6>]" % (sys.argv[0])
     sys.exit(1)
 
@@ -118,6 +123,16 @@ def getlocaltime(dt):
     return dt + utcoffset
 
 
+def getschedule(day):
+    """
+      return UTC times of morning twilight, tracking start, tracking end and evening twilight for a day
+    """
+    events = almanac(longitude, latitude, day, 1, (twilight_angle, tracking_angle))
+    ok, trise, ok, tset = events[twilight_angle]
+    ok, tstart, ok, tend = events[tracking_angle]
+    return jd_to_cd(trise[0]), jd_to_cd(tstart[0]), jd_to_cd(tend[0]), jd_to_cd(tset[0])
+
+
 if __name__ == "__main__":
 
     step = 60
@@ -129,13 +144,18 @@ if __name__ == "__main__":
     startFROM = False
     timeZone = "CET"
     calibrateon = [6]
+    ephemerisname = "full"
+    # "auto" picks the cheapest engine within tolerance, the table if it is good enough
+    tolerance = 0.05
+    tablefile = None
 
     import getopt
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], "hs:",
                                    ["help", "latitude=", "longitude=", "motor-driver-address=", "step=", "timewarp=",
-                                    "simulate", "startfrom=", "timezone=", "calibrateon="])
+                                    "simulate", "startfrom=", "timezone=", "calibrateon=", "ephemeris=",
+                                    "tolerance=", "table="])
     except getopt.GetoptError:
         # print help information and exit:
         print "Error parsing argument:", sys.exc_info()[1]
@@ -182,11 +202,29 @@ if __name__ == "__main__":
             timeWarp = int(a)
         if o == "--timezone":
             timeZone = a
+        if o == "--ephemeris":
+            ephemerisname = a
+        if o == "--tolerance":
+            tolerance = float(a)
+        if o == "--table":
+            tablefile = a
 
     log.info("Tracker location [%f,%f], timezone %s" % (latitude, longitude, timeZone))
     log.info("Step is %f seconds" % step)
     log.info("motor driver server address [%s:%d]" % (motordriveraddress, motordriverport))
     log.info("calibrateon %s" % calibrateon)
+    log.info("ephemeris %s" % ephemerisname)
+
+    try:
+        if ephemerisname == "auto":
+            engine = ephemeris.engine_for_tolerance(tolerance, tablefile)
+            log.info("ephemeris within %f degrees: %s" % (tolerance, engine.name))
+        else:
+            engine = ephemeris.get_engine(ephemerisname)
+        sun_az_alt = engine.sun_az_alt
+    except ValueError:
+        print "Error:", sys.exc_info()[1]
+        usage()
 
     if timeWarp:
         log.warn("simulation mode: timeWarp %d" % timeWarp)
@@ -215,15 +253,7 @@ if __name__ == "__main__":
     levt = now
 
     # day or night ?
-    ok, trise = sun_time(now, longitude, latitude, rising=True, angle=twilight_angle)
-    ok, tset = sun_time(now, longitude, latitude, rising=False, angle=twilight_angle)
-    trise = trise.replace(year=now.year, month=now.month, day=now.day)
-    tset = tset.replace(year=now.year, month=now.month, day=now.day)
-
-    ok, tstart = sun_time(now, longitude, latitude, rising=True, angle=tracking_angle)
-    ok, tend = sun_time(now, longitude, latitude, rising=False, angle=tracking_angle)
-    tstart = tstart.replace(year=now.year, month=now.month, day=now.day)
-    tend = tend.replace(year=now.year, month=now.month, day=now.day)
+    trise, tstart, tend, tset = getschedule(now.date())
 
     day = False
     track = False
@@ -232,11 +262,9 @@ if __name__ == "__main__":
     if now > tstart and now < tend:
         track = True
 
-    if not day:
-        trise = trise + datetime.timedelta(days=1)
-        tset = tset + datetime.timedelta(days=1)
-        tstart = tstart + datetime.timedelta(days=1)
-        tend = tend + datetime.timedelta(days=1)
+    if now >= tset:
+        # today is over, wait for tomorrow
+        trise, tstart, tend, tset = getschedule(now.date() + datetime.timedelta(days=1))
 
     log.info("Day: %s" % day)
     log.info("Track: %s" % track)
@@ -247,6 +275,9 @@ if __name__ == "__main__":
     log.info("tracking end at %s UTC - localtime %s" % (tend, getlocaltime(tend)))
     log.info("evening twilight at %s UTC - localtime %s" % (tset, getlocaltime(tset)))
 
+    # sun position while tracking, advanced incrementally from the engine
+    stepper = None
+
     t = unixtime()
     tevt = t
 
@@ -285,29 +316,16 @@ if __name__ == "__main__":
             track = False
 
         if event == "time" and track:
-            az, alt = sun_az_alt(now, longitude, latitude)
+            if stepper is None:
+                stepper = ephemeris.SunStepper(longitude, latitude, cd_to_jd(now), step, engine)
+            az, alt = stepper.position(cd_to_jd(now))
             log.info("  azimuth %f, elevation %f" % (az, alt))
             # convert az,alt to pitch and roll and send to motor controller
             sendcmd2motor("ae %f,%f" % (az, alt))
 
         if event == "night":
-            # recompute set & rise
-
-            ok, trise = sun_time(now, longitude, latitude, rising=True, angle=twilight_angle)
-            trise = trise.replace(year=now.year, month=now.month, day=now.day)
-            trise = trise + datetime.timedelta(days=1)
-
-            ok, tset = sun_time(now, longitude, latitude, rising=False, angle=twilight_angle)
-            tset = tset.replace(year=now.year, month=now.month, day=now.day)
-            tset = tset + datetime.timedelta(days=1)
-
-            ok, tstart = sun_time(now, longitude, latitude, rising=True, angle=tracking_angle)
-            tstart = tstart.replace(year=now.year, month=now.month, day=now.day)
-            tstart = tstart + datetime.timedelta(days=1)
-
-            ok, tend = sun_time(now, longitude, latitude, rising=False, angle=tracking_angle)
-            tend = tend.replace(year=now.year, month=now.month, day=now.day)
-            tend = tend + datetime.timedelta(days=1)
+            # recompute set & rise for tomorrow
+            trise, tstart, tend, tset = getschedule(now.date() + datetime.timedelta(days=1))
 
             log.info("morning twilight at %s UTC - localtime %s" % (trise, getlocaltime(trise)))
             log.info("tracking start at %s UTC - localtime %s" % (tstart, getlocaltime(tstart)))
@@ -320,9 +338,7 @@ if __name__ == "__main__":
             nowl = getlocaltime(now)
             if nowl.weekday() in calibrateon:
                 log.info("Calibration day !")
-                sendcmd2motor("roll calibrate")
-                sendcmd2motor("pitch calibrate")
-                sleep(10)
+                sendcmd2motor("calibrate both")
             #
             az, alt = sun_az_alt(tstart, longitude, latitude)
             log.info("  for next day azimuth %f, elevation %f" % (az, alt))
@@ -21,8 +21,18 @@ jst: "julian siderial time", number of siderial hours since 2000-1-1 epoch
 """
 
 from __future__ import division
+import array
+import collections
 import datetime as dtm
 import math
+import mmap
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is only needed by the *_array functions
+    np = None
 
 
 def _fract(x):
@@ -48,6 +58,65 @@ def jd_to_cd(jd):
     return result
 
 
+def unix_to_jd(ts):
+    """Convert seconds since the Unix epoch to Julian date."""
+    return ts / 86400.0 + 2440587.5
+
+
+def jd_to_unix(jd):
+    """Convert Julian date to seconds since the Unix epoch."""
+    return (jd - 2440587.5) * 86400.0
+
+
+class Epoch(object):
+    """Time dependent terms shared by all the stages of a sun position.
+
+    Computes the Julian date and the Julian century once; the arguments of the
+    nutation series are computed on first use and then reused by both
+    nutat_long and nutat_obl.
+
+    These functions accept an Epoch in place of their Greenwich date:
+    sun_long, nutat_long, nutat_obl, obliq, ecl_to_equ, ec_dec, ec_ra,
+    ut_to_gst, ra_to_ha, equ_to_hor, gst_to_ut, cd_to_jst, sun_time,
+    local_noon, sun_az_alt and the sun_az_alt methods of ChebyshevEphemeris
+    and EphemerisTable. Others, such as cd_to_jd and start_of_day, do not.
+    """
+    __slots__ = ['jd', 't', '_nutat']
+
+    def __init__(self, gdate):
+        self.jd = cd_to_jd(gdate)
+        self.t = (self.jd - 2415020.0) / 36525.0
+        self._nutat = None
+
+    @classmethod
+    def from_jd(cls, jd):
+        """Return the Epoch of a Julian date, without going through datetime."""
+        epoch = cls.__new__(cls)
+        epoch.jd = jd
+        epoch.t = (jd - 2415020.0) / 36525.0
+        epoch._nutat = None
+        return epoch
+
+    def nutat_args(self):
+        """Return the tuple (l2, d2, m1, m2, n1) used by the nutation terms."""
+        if self._nutat is None:
+            t = self.t
+            t2 = t * t
+            self._nutat = (2.0 * math.radians(279.6967 + 0.000303 * t2 + 360.0 * _fract(100.0021358 * t)),
+                           2.0 * math.radians(270.4342 - 0.001133 * t2 + 360.0 * _fract(1336.855231 * t)),
+                           math.radians(358.4758 - 0.00015 * t2 + 360.0 * _fract(99.99736056 * t)),
+                           math.radians(296.1046 + 0.009192 * t2 + 360.0 * _fract(1325.552359 * t)),
+                           math.radians(259.1833 + 0.002078 * t2 - 360.0 * _fract(5.372616667 * t)))
+        return self._nutat
+
+
+def _epoch(gdate):
+    """Return gdate as an Epoch, building it only if needed."""
+    if isinstance(gdate, Epoch):
+        return gdate
+    return Epoch(gdate)
+
+
 def start_of_day(gdatetime):
     """Set the time part of a datetime value to zero."""
     return gdatetime.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -87,7 +156,7 @@ def true_anomaly(am, ec):
 def sun_long(gdate):
     """Return sun longitude in degrees for given Greenwich datetime (UTC)."""
 
-    t = (cd_to_jd(gdate) - 2415020.0) / 36525.0
+    t = _epoch(gdate).t
     t2 = t * t
 
     l = 279.69668 + 0.0003025 * t2 + 360.0 * _fract(100.0021359 * t)
@@ -119,13 +188,9 @@ def sun_long(gdate):
 
 
 def nutat_long(gdate):
-    t = (cd_to_jd(gdate) - 2415020.0) / 36525.0
-    t2 = t * t
-    l2 = 2.0 * math.radians(279.6967 + 0.000303 * t2 + 360.0 * _fract(100.0021358 * t))
-    d2 = 2.0 * math.radians(270.4342 - 0.001133 * t2 + 360.0 * _fract(1336.855231 * t))
-    m1 = math.radians(358.4758 - 0.00015 * t2 + 360.0 * _fract(99.99736056 * t))
-    m2 = math.radians(296.1046 + 0.009192 * t2 + 360.0 * _fract(1325.552359 * t))
-    n1 = math.radians(259.1833 + 0.002078 * t2 - 360.0 * _fract(5.372616667 * t))
+    epoch = _epoch(gdate)
+    t = epoch.t
+    l2, d2, m1, m2, n1 = epoch.nutat_args()
 
     dp = ((-17.2327 - 0.01737 * t) * math.sin(n1) +
           (-1.2729 - 0.00013 * t) * math.sin(l2) + 0.2088 * math.sin(2 * n1) -
@@ -139,13 +204,9 @@ def nutat_long(gdate):
 
 
 def nutat_obl(gdate):
-    t = (cd_to_jd(gdate) - 2415020.0) / 36525.0
-    t2 = t * t
-    l2 = 2.0 * math.radians(279.6967 + 0.000303 * t2 + 360.0 * _fract(100.0021358 * t))
-    d2 = 2.0 * math.radians(270.4342 - 0.001133 * t2 + 360.0 * _fract(1336.855231 * t))
-    m1 = math.radians(358.4758 - 0.00015 * t2 + 360.0 * _fract(99.99736056 * t))
-    m2 = math.radians(296.1046 + 0.009192 * t2 + 360.0 * _fract(1325.552359 * t))
-    n1 = math.radians(259.1833 + 0.002078 * t2 - 360.0 * _fract(5.372616667 * t))
+    epoch = _epoch(gdate)
+    t = epoch.t
+    l2, d2, m1, m2, n1 = epoch.nutat_args()
 
     ddo = ((9.21 + 0.00091 * t) * math.cos(n1) +
            (0.5522 - 0.00029 * t) * math.cos(l2) - 0.0904 * math.cos(2 * n1) +
@@ -158,9 +219,10 @@ def nutat_obl(gdate):
 
 def obliq(gdate):
     """Return obliquity of orbit for a given datetime."""
-    c = ((cd_to_jd(gdate) - 2415020.0) / 36525.0) - 1.0
+    epoch = _epoch(gdate)
+    c = epoch.t - 1.0
     e = (c * (46.815 + c * (0.0006 - (c * 0.00181)))) / 3600.0
-    return 23.43929167 - e + nutat_obl(gdate)
+    return 23.43929167 - e + nutat_obl(epoch)
 
 
 def ecl_to_equ(eclon, eclat, gdate):
@@ -232,29 +294,42 @@ def gst_to_ut(gst, gdate):
 
     Time values are in hours, i.e. in the inverval [0, 24.0).
     """
-    gdate = start_of_day(gdate)
-    c = (cd_to_jd(gdate) - 2451545.0) / 36525.0
+    if isinstance(gdate, Epoch):
+        jd = math.floor(gdate.jd - 0.5) + 0.5
+    else:
+        jd = cd_to_jd(start_of_day(gdate))
+    c = (jd - 2451545.0) / 36525.0
     e = (6.697374558 + c * (2400.051336 + c * 0.000025862)) % 24.0
     return ((gst - e) % 24.0) * 0.9972695663
 
 
 def ut_to_gst(gdatetime):
     """Calculate Greenwich siderial time for a given Greenwich datetime."""
-    a = cd_to_jd(gdatetime) - 2451545.0
+    a = _epoch(gdatetime).jd - 2451545.0
     d = 18.697374558 + 24.06570982439425 * a + (0.000025862 * a * a) / 1334075625
     return d % 24.0
 
 
 def cd_to_jst(gdatetime):
     """Calculate number of siderial days since epoch J2000.0"""
-    a = cd_to_jd(gdatetime) - 2451545.0
+    return jd_to_jst(_epoch(gdatetime).jd)
+
+
+def jd_to_jst(jd):
+    """Calculate number of siderial days since epoch J2000.0 for a Julian date."""
+    a = jd - 2451545.0
     return (18.697374558 + 24.06570982441908 * a) / 24.0
 
 
+def jst_to_jd(jst):
+    """Return Julian date for a given number of siderial days (JST)."""
+    a = (jst * 24.0 - 18.697374558) / 24.06570982441908
+    return a + 2451545.0
+
+
 def jst_to_cd(jst):
     """Return calender date for a given number of siderial days (JST)."""
-    a = (jst * 24.0 - 18.697374558) / 24.06570982441908
-    return jd_to_cd(a + 2451545.0)
+    return jd_to_cd(jst_to_jd(jst))
 
 
 def riseset(ra, dec, vs, lat_obs):
@@ -297,40 +372,122 @@ def sun_time(gdatetime, lon_obs, lat_obs, rising=True, angle=0.83333333):
 
     Siderial times below are in the [0, 1] range instead of [0, 24].
     """
-    jst = cd_to_jst(gdatetime)
+    valid, jd = sun_time_jd(_epoch(gdatetime).jd, lon_obs, lat_obs, rising, angle)
+    return (valid, jd_to_cd(jd))
+
+
+def _sun_ra_dec(epoch):
+    """Return right ascension and declination of the sun for an Epoch."""
+    eclon = sun_long(epoch) + nutat_long(epoch) - 0.005694
+    return ecl_to_equ(eclon, 0, epoch)
+
+
+def sun_time_jd(jd, lon_obs, lat_obs, rising=True, angle=0.83333333):
+    """Same as sun_time, with times given and returned as Julian dates."""
+    jst = jd_to_jst(jd)
     sign = -1 if rising else 1
     # solved by approximation, two iterations should be good enough
     for _ in xrange(2):
-        eclon = sun_long(gdatetime) + nutat_long(gdatetime) - 0.005694
-        ra, dec = ecl_to_equ(eclon, 0, gdatetime)
-        # angle between noon and requested position:
-        valid, delta_ra = riseset(ra, dec, angle, lat_obs)
-
-        lst = _fract(jst)
-        transit_st = _fract((ra - lon_obs) / 360.0)
-        delta = 0.0
-        if abs(lst - transit_st) > 1.0 / 24.0:
-            # times lie on different sides of a siderial day boundary
-            if transit_st > lst:
-                # suppose transit_st is in the previous siderial day
-                delta = -1.0
-            else:
-                # transit_st is in the following siderial day
-                delta = 1.0
-        # math.floor(jst) + delta + transit_st is the siderial time of solar noon
-        gdatetime = jst_to_cd(math.floor(jst) + delta + transit_st + sign * delta_ra / 360.0)
-
-    return (valid, gdatetime)
+        ra, dec = _sun_ra_dec(Epoch.from_jd(jd))
+        valid, jd = _sun_time_step(jst, ra, dec, lon_obs, lat_obs, sign, angle)
+
+    return (valid, jd)
+
+
+def _sun_time_step(jst, ra, dec, lon_obs, lat_obs, sign, angle):
+    """One approximation step of sun_time_jd, given the sun position (ra,
+    dec) at the current estimate; return validity and the new estimate."""
+    # angle between noon and requested position:
+    valid, delta_ra = riseset(ra, dec, angle, lat_obs)
+
+    lst = _fract(jst)
+    transit_st = _fract((ra - lon_obs) / 360.0)
+    delta = 0.0
+    if abs(lst - transit_st) > 1.0 / 24.0:
+        # times lie on different sides of a siderial day boundary
+        if transit_st > lst:
+            # suppose transit_st is in the previous siderial day
+            delta = -1.0
+        else:
+            # transit_st is in the following siderial day
+            delta = 1.0
+    # math.floor(jst) + delta + transit_st is the siderial time of solar noon
+    return (valid, jst_to_jd(math.floor(jst) + delta + transit_st + sign * delta_ra / 360.0))
+
+
+def sun_time_unix(ts, lon_obs, lat_obs, rising=True, angle=0.83333333):
+    """Same as sun_time, with times given and returned as Unix seconds."""
+    valid, jd = sun_time_jd(unix_to_jd(ts), lon_obs, lat_obs, rising, angle)
+    return (valid, jd_to_unix(jd))
+
+
+def almanac(lon_obs, lat_obs, start_date, days, angles):
+    """Return rising and setting times of the sun at several vertical angles
+    for consecutive days.
+
+    Every event is computed as sun_time does for the local noon of its day,
+    with the same two approximation steps, and the results are the same. The
+    first step only needs the sun position at local noon: it is computed once
+    per day and shared by all the events of that day. With numpy all days
+    and events are computed together as arrays.
+
+    start_date: first day (a date, UTC).
+    days: number of days.
+    angles: vertical angles, as the angle parameter of sun_time.
+
+    Return value is a dictionary mapping every angle to a tuple (rise_valid,
+    rise, set_valid, set): arrays (lists without numpy) with one Julian date
+    or validity flag per day, see sun_time.
+    """
+    # local noon, starting from 12h UTC, works for both signs of longitude
+    jd0 = cd_to_jd(start_date) + 0.5
+    events = [(angle, sign) for angle in angles for sign in (-1, 1)]
+    result = {}
+
+    if np is not None:
+        noon = np.floor(jd0 + np.arange(days) + lon_obs / 360.0 + 0.5) - lon_obs / 360.0
+        jst = jd_to_jst(noon)
+        ra, dec = _sun_ra_dec_array(noon)
+        first = [_sun_time_step_array(jst, ra, dec, lon_obs, lat_obs, sign, angle) for angle, sign in events]
+        # second step for all events at once
+        ra, dec = _sun_ra_dec_array(np.concatenate([jd for _, jd in first]))
+        for i, (angle, sign) in enumerate(events):
+            part = slice(i * days, (i + 1) * days)
+            result[angle, sign] = _sun_time_step_array(jst, ra[part], dec[part], lon_obs, lat_obs, sign, angle)
+    else:
+        for angle, sign in events:
+            result[angle, sign] = ([], [])
+        for day in xrange(days):
+            noon = local_noon_jd(jd0 + day, lon_obs)
+            jst = jd_to_jst(noon)
+            ra, dec = _sun_ra_dec(Epoch.from_jd(noon))
+            for angle, sign in events:
+                valid, jd = _sun_time_step(jst, ra, dec, lon_obs, lat_obs, sign, angle)
+                ra1, dec1 = _sun_ra_dec(Epoch.from_jd(jd))
+                valid, jd = _sun_time_step(jst, ra1, dec1, lon_obs, lat_obs, sign, angle)
+                result[angle, sign][0].append(valid)
+                result[angle, sign][1].append(jd)
+
+    return dict((angle, result[angle, -1] + result[angle, 1]) for angle in angles)
 
 
 def local_noon(gdatetime, lon_obs):
     """Return UTC time of local noon for given date and time (also UTC)."""
+    if isinstance(gdatetime, Epoch):
+        return jd_to_cd(local_noon_jd(gdatetime.jd, lon_obs))
     dtlocal = dtm.timedelta(hours=lon_obs / 15.0)
     gdatetime = start_of_day(gdatetime + dtlocal) + dtm.timedelta(hours=12)
     gdatetime -= dtlocal
     return gdatetime
 
 
+def local_noon_jd(jd, lon_obs):
+    """Return Julian date of local noon for the day of a given Julian date."""
+    dtlocal = lon_obs / 360.0
+    # julian days start at noon, local civil days at jd + 0.5
+    return math.floor(jd + dtlocal + 0.5) - dtlocal
+
+
 def sun_calc(lon_obs, lat_obs):
     """Return a function that calls 'sun_time' with hard-coded coordinates.
 
@@ -344,9 +501,433 @@ def sun_calc(lon_obs, lat_obs):
 
 def sun_az_alt(gdatetime, lon_obs, lat_obs):
     """Return azimuth and altitude of the sun."""
-    eclon = sun_long(gdatetime) + nutat_long(gdatetime) - 0.005694
-    ra, dec = ecl_to_equ(eclon, 0, gdatetime)
-    return equ_to_hor(ra, dec, gdatetime, lon_obs, lat_obs)
+    epoch = _epoch(gdatetime)
+    ra, dec = _sun_ra_dec(epoch)
+    return equ_to_hor(ra, dec, epoch, lon_obs, lat_obs)
+
+
+def sun_az_alt_jd(jd, lon_obs, lat_obs):
+    """Return azimuth and altitude of the sun for a Julian date."""
+    epoch = Epoch.from_jd(jd)
+    ra, dec = _sun_ra_dec(epoch)
+    return equ_to_hor(ra, dec, epoch, lon_obs, lat_obs)
+
+
+def sun_az_alt_unix(ts, lon_obs, lat_obs):
+    """Return azimuth and altitude of the sun for a time in Unix seconds."""
+    return sun_az_alt_jd(unix_to_jd(ts), lon_obs, lat_obs)
+
+
+def _chebyshev_nodes(n):
+    """Return the n Chebyshev nodes in [-1, 1]."""
+    return [math.cos(math.pi * (k + 0.5) / n) for k in xrange(n)]
+
+
+def _chebyshev_fit(values):
+    """Return the coefficients of the Chebyshev series interpolating values
+    given at the nodes returned by _chebyshev_nodes(len(values))."""
+    n = len(values)
+    coeffs = [2.0 / n * sum(v * math.cos(math.pi * j * (k + 0.5) / n) for k, v in enumerate(values))
+              for j in xrange(n)]
+    coeffs[0] *= 0.5
+    return coeffs
+
+
+def _chebyshev_eval(coeffs, x):
+    """Evaluate a Chebyshev series at x in [-1, 1] (Clenshaw recurrence)."""
+    b1 = b2 = 0.0
+    x2 = 2.0 * x
+    for c in reversed(coeffs[1:]):
+        b1, b2 = x2 * b1 - b2 + c, b1
+    return x * b1 - b2 + coeffs[0]
+
+
+class ChebyshevEphemeris(object):
+    """Sun positions from a Chebyshev fit of the daily path of the sun.
+
+    For every UTC day right ascension and declination are sampled from the
+    full model at the Chebyshev nodes of the day and fitted once with a
+    polynomial of the given degree. A lookup then evaluates two polynomials
+    and converts to horizontal coordinates, without the ephemeris series.
+
+    With the default degree 6 the maximum difference from sun_az_alt over
+    years 2000-2050, at latitudes from -35 to 60 degrees, is 6e-5 degrees of
+    arc both in altitude and in azimuth times cos(altitude). This is the
+    numerical noise of the full model itself, whose eccentric anomaly is
+    solved to 1e-6 radians; the truncation error of the fit is far smaller.
+
+    Fits are kept in a LRU cache keyed by day and site, holding at most
+    maxfits entries.
+    """
+
+    def __init__(self, degree=6, maxfits=8):
+        self.degree = degree
+        self.maxfits = maxfits
+        self.fits = collections.OrderedDict()
+        self.lastkey = None
+        self.lastfit = None
+
+    def fit(self, day, lon_obs, lat_obs):
+        """Return the fit for a day, given as the Julian date of its 0h UTC.
+
+        The fit is a tuple (ra coefficients, dec coefficients, sin(lat),
+        cos(lat)), ra is unwrapped so that it is continuous over the day.
+        """
+        key = (day, lon_obs, lat_obs)
+        fit = self.fits.pop(key, None)
+        if fit is None:
+            radec = [_sun_ra_dec(Epoch.from_jd(day + (x + 1.0) * 0.5))
+                     for x in _chebyshev_nodes(self.degree + 1)]
+            ra = [radec[0][0]]
+            for r, _ in radec[1:]:
+                # keep ra continuous across 0/360
+                ra.append(r + 360.0 * round((ra[-1] - r) / 360.0))
+            lat = math.radians(lat_obs)
+            fit = (_chebyshev_fit(ra), _chebyshev_fit([dec for _, dec in radec]),
+                   math.sin(lat), math.cos(lat))
+            while len(self.fits) >= self.maxfits:
+                self.fits.popitem(last=False)
+        self.fits[key] = fit
+        return fit
+
+    def sun_az_alt(self, gdatetime, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun, same as sun.sun_az_alt."""
+        return self.sun_az_alt_jd(_epoch(gdatetime).jd, lon_obs, lat_obs)
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun for a Julian date."""
+        day = math.floor(jd - 0.5) + 0.5
+        key = (day, lon_obs, lat_obs)
+        if key == self.lastkey:
+            fit = self.lastfit
+        else:
+            fit = self.fit(day, lon_obs, lat_obs)
+            self.lastkey = key
+            self.lastfit = fit
+        racoeffs, deccoeffs, sinlat, coslat = fit
+
+        x = 2.0 * (jd - day) - 1.0
+        ra = _chebyshev_eval(racoeffs, x)
+        dec = math.radians(_chebyshev_eval(deccoeffs, x))
+        a = jd - 2451545.0
+        gst = 18.697374558 + 24.06570982439425 * a + (0.000025862 * a * a) / 1334075625
+        ha = math.radians((gst % 24.0) * 15.0 - ra + lon_obs)
+        sindec = math.sin(dec)
+        cosdec = math.cos(dec)
+        sinalt = sindec * sinlat + cosdec * coslat * math.cos(ha)
+        a = -cosdec * coslat * math.sin(ha)
+        b = sindec - sinlat * sinalt
+        az = math.degrees(math.atan2(a, b)) % 360.0
+        return (az, math.degrees(math.asin(sinalt)))
+
+
+# Precomputed ephemeris tables: a 64 bytes header followed by float32
+# (azimuth, altitude) pairs, little endian, sampled every 'step' seconds
+# from jd0 for a single site.
+_TABLE_MAGIC = "SUNTABLE"
+_TABLE_HEADER = struct.Struct("<8sIddddI")
+_TABLE_HEADER_SIZE = 64
+# rounding of float32 azimuth and altitude, degrees
+_TABLE_ROUNDING = 2e-5
+# largest obliquity of the ecliptic, nutation included, degrees
+_MAX_OBLIQUITY = 23.45
+
+
+def write_ephemeris_table(filename, lon_obs, lat_obs, start_year, end_year, step=60):
+    """Write the sun positions of a site for years start_year..end_year
+    (inclusive) to a binary table file, one sample every step seconds.
+
+    Uses sun_az_alt_array when numpy is available, sun_az_alt_jd otherwise.
+    """
+    jd0 = cd_to_jd(dtm.date(start_year, 1, 1))
+    jd1 = cd_to_jd(dtm.date(end_year + 1, 1, 1))
+    count = int(round((jd1 - jd0) * 86400.0 / step)) + 1
+    output = open(filename, 'wb')
+    try:
+        output.write(_TABLE_HEADER.pack(_TABLE_MAGIC, 1, lon_obs, lat_obs, jd0, step, count)
+                     .ljust(_TABLE_HEADER_SIZE, "\0"))
+        # one day of samples at a time keeps memory small
+        chunk = int(86400 // step) + 1
+        for first in xrange(0, count, chunk):
+            n = min(chunk, count - first)
+            if np is not None:
+                jd = jd0 + (first + np.arange(n)) * (step / 86400.0)
+                az, alt = sun_az_alt_array(jd_to_unix(jd), lon_obs, lat_obs)
+                data = np.empty(2 * n, dtype='<f4')
+                data[0::2] = az
+                data[1::2] = alt
+                output.write(data.tostring())
+            else:
+                data = array.array('f')
+                for i in xrange(first, first + n):
+                    data.extend(sun_az_alt_jd(jd0 + i * step / 86400.0, lon_obs, lat_obs))
+                if struct.pack('=f', 1.0) != struct.pack('<f', 1.0):
+                    data.byteswap()
+                output.write(data.tostring())
+    finally:
+        output.close()
+
+
+class EphemerisTable(object):
+    """Sun positions read from a table written by write_ephemeris_table.
+
+    The file is memory mapped read only, so every process using the same
+    table shares the operating system page cache. A lookup unpacks the two
+    samples around the requested time and interpolates linearly: no
+    trigonometry, constant time. With one minute steps the interpolation
+    error is below 3e-4 degrees at the default site of solar-tracker.py.
+
+    maxerror bounds the interpolation error for the table site: it grows as
+    the sun passes close to the zenith or the nadir, where azimuth turns
+    fast, up to the sun motion in a step between the tropics.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        handle = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            handle.close()
+        magic, version, self.lon, self.lat, self.jd0, self.step, self.count = \
+            _TABLE_HEADER.unpack_from(self.map, 0)
+        if magic != _TABLE_MAGIC or version != 1:
+            raise ValueError("%s is not a sun ephemeris table" % filename)
+        self.samplesperday = 86400.0 / self.step
+        self.jd1 = self.jd0 + (self.count - 1) / self.samplesperday
+        # a step moves the sun by 'move' degrees along a nearly straight path whose
+        # closest approach to zenith or nadir is 'closest': interpolating there is
+        # off by move**2 / (8 * closest) at most, and never by more than move
+        move = 360.0 * self.step / 86400.0
+        closest = max(0.0, abs(self.lat) - _MAX_OBLIQUITY)
+        self.maxerror = _TABLE_ROUNDING + (min(move, move ** 2 / (8 * closest)) if closest else move)
+
+    def close(self):
+        self.map.close()
+
+    def sun_az_alt(self, gdatetime, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun, same as sun.sun_az_alt."""
+        return self.sun_az_alt_jd(_epoch(gdatetime).jd, lon_obs, lat_obs)
+
+    def sun_az_alt_jd(self, jd, lon_obs, lat_obs):
+        """Return azimuth and altitude of the sun for a Julian date."""
+        if lon_obs != self.lon or lat_obs != self.lat:
+            raise ValueError("table %s is for site [%f,%f], not [%f,%f]" %
+                             (self.filename, self.lon, self.lat, lon_obs, lat_obs))
+        x = (jd - self.jd0) * self.samplesperday
+        i = int(x)
+        if x < 0 or i >= self.count - 1:
+            if x == self.count - 1:
+                i -= 1
+            else:
+                raise ValueError("%s out of table %s range" % (jd, self.filename))
+        f = x - i
+        az0, alt0, az1, alt1 = struct.unpack_from("<4f", self.map, _TABLE_HEADER_SIZE + 8 * i)
+        # interpolate azimuth along the shortest way around the circle
+        if az1 - az0 > 180.0:
+            az1 -= 360.0
+        elif az0 - az1 > 180.0:
+            az1 += 360.0
+        return ((az0 + (az1 - az0) * f) % 360.0, alt0 + (alt1 - alt0) * f)
+
+
+# Vectorized versions of the functions above. They work on numpy arrays of
+# Julian dates instead of single datetime values and follow the scalar code
+# step by step, so results agree with sun_az_alt to floating point precision.
+
+def _fract_array(x):
+    return x - np.trunc(x)
+
+
+def times_to_jd_array(times):
+    """Convert an array of timestamps to Julian dates.
+
+    times: numpy datetime64 values (UTC), datetime objects (UTC) or
+           numbers of seconds since the Unix epoch.
+    """
+    t = np.asarray(times)
+    if t.dtype == object:
+        t = t.astype('datetime64[us]')
+    if np.issubdtype(t.dtype, np.datetime64):
+        t = (t - np.datetime64('1970-01-01T00:00:00', 'us')) / np.timedelta64(1, 's')
+    return unix_to_jd(t)
+
+
+def eccentric_anomaly_array(am, ec):
+    """Vectorized eccentric_anomaly, am and ec may be arrays."""
+    m = np.mod(am, 2 * math.pi)
+    ae = m
+    while 1:
+        d = ae - (ec * np.sin(ae)) - m
+        active = np.abs(d) >= 0.000001
+        if not active.any():
+            break
+        # converged elements are left untouched, as in the scalar loop
+        ae = np.where(active, ae - d / (1.0 - (ec * np.cos(ae))), ae)
+    return ae
+
+
+def true_anomaly_array(am, ec):
+    ae = eccentric_anomaly_array(am, ec)
+    return 2.0 * np.arctan(np.sqrt((1.0 + ec) / (1.0 - ec)) * np.tan(ae * 0.5))
+
+
+def sun_long_array(jd):
+    """Vectorized sun_long for an array of Julian dates."""
+    t = (jd - 2415020.0) / 36525.0
+    t2 = t * t
+
+    l = 279.69668 + 0.0003025 * t2 + 360.0 * _fract_array(100.0021359 * t)
+    m1 = 358.47583 - (0.00015 + 0.0000033 * t) * t2 + 360.0 * _fract_array(99.99736042 * t)
+    ec = 0.01675104 - 0.0000418 * t - 0.000000126 * t2
+
+    at = true_anomaly_array(np.radians(m1), ec)
+
+    a1 = np.radians(153.23 + 360.0 * _fract_array(62.55209472 * t))
+    b1 = np.radians(216.57 + 360.0 * _fract_array(125.1041894 * t))
+    c1 = np.radians(312.69 + 360.0 * _fract_array(91.56766028 * t))
+    d1 = np.radians(350.74 - 0.00144 * t2 + 360.0 * _fract_array(1236.853095 * t))
+    e1 = np.radians(231.19 + 20.2 * t)
+
+    d2 = (0.00134 * np.cos(a1) + 0.00154 * np.cos(b1) + 0.002 * np.cos(c1) +
+          0.00179 * np.sin(d1) + 0.00178 * np.sin(e1))
+
+    sr = np.mod(at + np.radians(l - m1 + d2), 2 * math.pi)
+    return np.degrees(sr)
+
+
+def _nutat_args_array(t):
+    t2 = t * t
+    l2 = 2.0 * np.radians(279.6967 + 0.000303 * t2 + 360.0 * _fract_array(100.0021358 * t))
+    d2 = 2.0 * np.radians(270.4342 - 0.001133 * t2 + 360.0 * _fract_array(1336.855231 * t))
+    m1 = np.radians(358.4758 - 0.00015 * t2 + 360.0 * _fract_array(99.99736056 * t))
+    m2 = np.radians(296.1046 + 0.009192 * t2 + 360.0 * _fract_array(1325.552359 * t))
+    n1 = np.radians(259.1833 + 0.002078 * t2 - 360.0 * _fract_array(5.372616667 * t))
+    return l2, d2, m1, m2, n1
+
+
+def nutat_long_array(jd):
+    t = (jd - 2415020.0) / 36525.0
+    l2, d2, m1, m2, n1 = _nutat_args_array(t)
+
+    dp = ((-17.2327 - 0.01737 * t) * np.sin(n1) +
+          (-1.2729 - 0.00013 * t) * np.sin(l2) + 0.2088 * np.sin(2 * n1) -
+          0.2037 * np.sin(d2) + (0.1261 - 0.00031 * t) * np.sin(m1) +
+          0.0675 * np.sin(m2) - (0.0497 - 0.00012 * t) * np.sin(l2 + m1) -
+          0.0342 * np.sin(d2 - n1) - 0.0261 * np.sin(d2 + m2) +
+          0.0214 * np.sin(l2 - m1) - 0.0149 * np.sin(l2 - d2 + m2) +
+          0.0124 * np.sin(l2 - n1) + 0.0114 * np.sin(d2 - m2))
+
+    return dp / 3600.0
+
+
+def nutat_obl_array(jd):
+    t = (jd - 2415020.0) / 36525.0
+    l2, d2, m1, m2, n1 = _nutat_args_array(t)
+
+    ddo = ((9.21 + 0.00091 * t) * np.cos(n1) +
+           (0.5522 - 0.00029 * t) * np.cos(l2) - 0.0904 * np.cos(2 * n1) +
+           0.0884 * np.cos(d2) + 0.0216 * np.cos(l2 + m1) +
+           0.0183 * np.cos(d2 - n1) + 0.0113 * np.cos(d2 + m2) -
+           0.0093 * np.cos(l2 - m1) - 0.0066 * np.cos(l2 - n1))
+
+    return ddo / 3600.0
+
+
+def obliq_array(jd):
+    c = ((jd - 2415020.0) / 36525.0) - 1.0
+    e = (c * (46.815 + c * (0.0006 - (c * 0.00181)))) / 3600.0
+    return 23.43929167 - e + nutat_obl_array(jd)
+
+
+def ecl_to_equ_array(eclon, eclat, jd):
+    """Vectorized ecl_to_equ, return a tuple of ra and dec arrays."""
+    a = np.radians(eclon)
+    b = np.radians(eclat)
+    c = np.radians(obliq_array(jd))
+    d = np.sin(a) * np.cos(c) - np.tan(b) * np.sin(c)
+    e = np.cos(a)
+    ra = np.mod(np.degrees(np.arctan2(d, e)), 360.0)
+
+    f = np.sin(b) * np.cos(c) + np.cos(b) * np.sin(c) * np.sin(a)
+    dec = np.degrees(np.arcsin(f))
+    return (ra, dec)
+
+
+def ut_to_gst_array(jd):
+    a = jd - 2451545.0
+    d = 18.697374558 + 24.06570982439425 * a + (0.000025862 * a * a) / 1334075625
+    return np.mod(d, 24.0)
+
+
+def equ_to_hor_array(ra, dec, jd, lon_obs, lat_obs):
+    """Vectorized equ_to_hor, return a tuple of azimuth and altitude arrays."""
+    dec = np.radians(dec)
+    lat_obs = np.radians(lat_obs)
+    ha = np.radians(np.mod(ut_to_gst_array(jd) - (ra - lon_obs) / 15.0, 24.0) * 15.0)
+    sinalt = np.sin(dec) * np.sin(lat_obs) + np.cos(dec) * np.cos(lat_obs) * np.cos(ha)
+    a = -np.cos(dec) * np.cos(lat_obs) * np.sin(ha)
+    b = np.sin(dec) - np.sin(lat_obs) * sinalt
+    az = np.mod(np.degrees(np.arctan2(a, b)), 360.0)
+    return (az, np.degrees(np.arcsin(sinalt)))
+
+
+def _sun_ra_dec_array(jd):
+    eclon = sun_long_array(jd) + nutat_long_array(jd) - 0.005694
+    return ecl_to_equ_array(eclon, 0, jd)
+
+
+def sun_az_alt_array(times, lon_obs, lat_obs):
+    """Return azimuth and altitude arrays of the sun for an array of times.
+
+    times: see times_to_jd_array.
+    """
+    jd = times_to_jd_array(times)
+    ra, dec = _sun_ra_dec_array(jd)
+    return equ_to_hor_array(ra, dec, jd, lon_obs, lat_obs)
+
+
+def sun_az_alt_sites(times, lons_obs, lats_obs):
+    """Return azimuth and altitude of the sun for several sites, as two
+    (N_sites x N_times) arrays.
+
+    The site independent part (sun longitude, nutation, obliquity, sidereal
+    time) is computed once per time and broadcast over the sites.
+    times: see times_to_jd_array; lons_obs, lats_obs: one value per site.
+    """
+    lons = np.asarray(lons_obs, dtype=float).reshape(-1, 1)
+    lats = np.radians(np.asarray(lats_obs, dtype=float)).reshape(-1, 1)
+    if lons.shape != lats.shape:
+        raise ValueError("%d longitudes for %d latitudes" % (len(lons), len(lats)))
+    jd = times_to_jd_array(times)
+    ra, dec = _sun_ra_dec_array(jd)
+    dec = np.radians(dec)
+    sindec = np.sin(dec)
+    cosdec = np.cos(dec)
+    sinlat = np.sin(lats)
+    coslat = np.cos(lats)
+    ha = np.radians(np.mod(ut_to_gst_array(jd) - (ra - lons) / 15.0, 24.0) * 15.0)
+    sinalt = sindec * sinlat + cosdec * coslat * np.cos(ha)
+    a = -cosdec * coslat * np.sin(ha)
+    b = sindec - sinlat * sinalt
+    az = np.mod(np.degrees(np.arctan2(a, b)), 360.0)
+    return (az, np.degrees(np.arcsin(sinalt)))
+
+
+def _sun_time_step_array(jst, ra, dec, lon_obs, lat_obs, sign, angle):
+    """Vectorized _sun_time_step."""
+    dec = np.radians(dec)
+    vs = math.radians(angle)
+    lat = math.radians(lat_obs)
+    f = -(math.sin(vs) + np.sin(dec) * math.sin(lat)) / (np.cos(dec) * math.cos(lat))
+    valid = np.abs(f) < 1.0
+    # noon if sun always below angle, midnight if always above, as riseset
+    delta_ra = np.where(valid, np.degrees(np.arccos(np.clip(f, -1.0, 1.0))), np.where(f > 0.0, 0.0, 180.0))
+
+    lst = _fract_array(jst)
+    transit_st = _fract_array((ra - lon_obs) / 360.0)
+    delta = np.where(np.abs(lst - transit_st) > 1.0 / 24.0, np.where(transit_st > lst, -1.0, 1.0), 0.0)
+    return (valid, jst_to_jd(np.floor(jst) + delta + transit_st + sign * delta_ra / 360.0))
 
 
 if __name__ == '__main__':
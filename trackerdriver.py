@@ -8,17 +8,48 @@ import logging.handlers
 import linearmotor
 import pickle
 import os
-from Vec3d import Vec3d
+import hashlib
+import threading
+import contextlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def getpitchroll(azi, ele):
-    vz = math.sin(math.radians(ele))
-    vx = -math.cos(math.radians(azi)) * math.cos(math.radians(ele))
-    vy = math.sin(math.radians(azi)) * math.cos(math.radians(ele))
-    v = Vec3d(vy, vx, vz)
-    pitch = v.get_angle_around_x() - 90
-    v.rotate_around_x(-pitch)
-    roll = v.get_angle_around_y()
+    """
+      pitch and roll angles pointing at azimuth azi, elevation ele
+      the sun vector is rotated around x to the YZ-plane zenith (pitch), then its
+      angle around y is the roll; in closed form, as the rotation keeps the
+      length of the YZ component
+    """
+    az = math.radians(azi)
+    el = math.radians(ele)
+    cosel = math.cos(el)
+    x = math.sin(az) * cosel
+    y = -math.cos(az) * cosel
+    z = math.sin(el)
+    pitch = math.degrees(math.atan2(z, y)) - 90
+    roll = math.degrees(math.atan2(x, math.hypot(y, z)))
+
+    return pitch, roll
+
+
+def getpitchroll_array(azi, ele):
+    """
+      getpitchroll for arrays of azimuth and elevation (numpy)
+    """
+    az = np.radians(azi)
+    el = np.radians(ele)
+    cosel = np.cos(el)
+    x = np.sin(az) * cosel
+    y = -np.cos(az) * cosel
+    z = np.sin(el)
+    pitch = np.degrees(np.arctan2(z, y)) - 90
+    roll = np.degrees(np.arctan2(x, np.hypot(y, z)))
 
     return pitch, roll
 
@@ -29,6 +60,9 @@ class TrackerDriver:
         self.rollMotor = rollmotor
         self.aziOffset = azioffset
         self.statefile = statefile
+        self.positionGrid = None
+        # linearmotor.GpioBank the motors write to, see relays
+        self.gpioBank = None
         self.restorestate()
 
     def gotopitchposition(self, pos):
@@ -64,83 +98,72 @@ class TrackerDriver:
             rollpos = 0
             log.info("roll forced to 0")
 
-        self.rollMotor.wait = 0
-        self.pitchMotor.wait = 0
-
         #
         pitch = False
-        if abs(pitchpos - self.pitchMotor.pos) >= self.pitchMotor.minstep:
-            if pitchpos > self.pitchMotor.pos:
-                self.pitchMotor.forward()
-            else:
-                self.pitchMotor.backward()
-            pitch = True
-
         roll = False
-        if abs(rollpos - self.rollMotor.pos) >= self.rollMotor.minstep:
-            if rollpos > self.rollMotor.pos:
-                self.rollMotor.forward()
-            else:
-                self.rollMotor.backward()
-            roll = True
-
-        if pitch or roll:
-            time.sleep(.2)  # wait direction relais set-up
-        if pitch:
-            self.pitchMotor.on()
-        if roll:
-            self.rollMotor.on()
-
-        oroll = -999
-        opitch = -999
-        txr = time.time()
-        txp = txr
-
-        while pitch or roll:
-            # log.info( "pitch pos %d, roll pos %d" % (self.pitchMotor.pos,self.rollMotor.pos))
-            ty = time.time()
-            if pitch:
-                if ty - txp > .5:
-                    txp = ty
-                    if self.pitchMotor.pos == opitch:
-                        pitch = False
-                    opitch = self.pitchMotor.pos
-                if self.pitchMotor.step > 0:
-                    # forward
-                    if self.pitchMotor.pos > pitchpos - 2:
-                        pitch = False
+        with self.relays():
+            if abs(pitchpos - self.pitchMotor.pos) >= self.pitchMotor.minstep:
+                if pitchpos > self.pitchMotor.pos:
+                    self.pitchMotor.forward()
                 else:
-                    # backward
-                    if self.pitchMotor.pos < pitchpos + 2:
-                        pitch = False
-                if not pitch:
-                    self.pitchMotor.off()
+                    self.pitchMotor.backward()
+                pitch = True
 
-            if roll:
-                if ty - txr > .5:
-                    txr = ty
-                    if self.rollMotor.pos == oroll:
-                        roll = False
-                    oroll = self.rollMotor.pos
-
-                if self.rollMotor.step > 0:
-                    # forward
-                    if self.rollMotor.pos > rollpos - 2:
-                        roll = False
+            if abs(rollpos - self.rollMotor.pos) >= self.rollMotor.minstep:
+                if rollpos > self.rollMotor.pos:
+                    self.rollMotor.forward()
                 else:
-                    # backward
-                    if self.rollMotor.pos < rollpos + 2:
-                        roll = False
-                if not roll:
-                    self.rollMotor.off()
+                    self.rollMotor.backward()
+                roll = True
+
+        # motors stop themselves on the target pulse, see LinearMotor.settarget;
+        # on() waits for the direction relays, switched together above
+        done = threading.Event()
+        moving = []
+        with self.relays():
+            if pitch:
+                self.pitchMotor.settarget(pitchpos, done)
+                self.pitchMotor.on()
+                moving.append(self.pitchMotor)
+            if roll:
+                self.rollMotor.settarget(rollpos, done)
+                self.rollMotor.on()
+                moving.append(self.rollMotor)
 
-            time.sleep(.1)
+        linearmotor.waittargets(moving, done)
+        for motor in moving:
+            motor.settle()
 
         log.info("pitch pos %d, roll pos %d" % (self.pitchMotor.pos, self.rollMotor.pos))
+        self.savestate()
 
-        self.rollMotor.wait = .2
-        self.pitchMotor.wait = .2
+    def calibrateboth(self):
+        """
+          calibrate pitch and roll at the same time, each motor stopping at its end stop
+        """
+        tstart = time.time()
+        motors = (self.pitchMotor, self.rollMotor)
+        with self.relays():
+            for motor in motors:
+                motor.backward()
+        with self.relays():
+            for motor in motors:
+                motor.startcalibration()
+        linearmotor.waitendstops(motors)
+        result = [motor.endcalibration(tstart) for motor in motors]
         self.savestate()
+        return result
+
+    @contextlib.contextmanager
+    def relays(self):
+        """
+          the motor gpio writes in the block go out as one bank write, if there is a gpioBank
+        """
+        if self.gpioBank is None:
+            yield
+        else:
+            with self.gpioBank:
+                yield
 
     def gotopitchrollangle(self, pitchangle, rollangle):
         """
@@ -170,15 +193,37 @@ class TrackerDriver:
 
             log.info("correcting azi to %f due to offset of %f" % (az, self.aziOffset))
 
+        if self.positionGrid is not None:
+            pos = self.positionGrid.lookup(az, alt)
+            if pos is not None:
+                log.info("  grid position [pitch %f, roll %f]" % pos)
+                self.gotopitchrollpos(pos[0], pos[1])
+                return
+
         pr = getpitchroll(az, alt)
         log.info("  pitch [%f], roll [%f]" % (pr[0], pr[1]))
         self.gotopitchrollangle(pr[0], pr[1])
 
+    def aziele2pos_array(self, az, alt):
+        """
+          gotoaziele computations for arrays of azi, ele (numpy), without moving:
+          return clipped pitch and roll angles and the motor positions
+        """
+        az = np.asarray(az, dtype=float)
+        if self.aziOffset != 0:
+            az = np.mod(az + self.aziOffset, 360.0)
+        pitchangle, rollangle = getpitchroll_array(az, alt)
+        pitchangle = self.pitchMotor.fixangle_array(pitchangle)
+        rollangle = self.rollMotor.fixangle_array(rollangle)
+        return (pitchangle, rollangle,
+                self.pitchMotor.angle2pos_array(pitchangle), self.rollMotor.angle2pos_array(rollangle))
+
     def savestate(self):
         """
-          save tracker state (motor position)
+          save tracker state (motor position and learned motion parameters)
         """
-        state = (self.pitchMotor.pos, self.rollMotor.pos)
+        state = (self.pitchMotor.pos, self.rollMotor.pos,
+                 {"pitch": self.pitchMotor.getlearned(), "roll": self.rollMotor.getlearned()})
         output = open(self.statefile, 'wb')
         # Pickle dictionary using protocol 0.
         pickle.dump(state, output)
@@ -195,7 +240,10 @@ class TrackerDriver:
             state = pickle.load(inputhandle)
             inputhandle.close()
 
-            self.pitchMotor.pos, self.rollMotor.pos = state
+            self.pitchMotor.pos, self.rollMotor.pos = state[:2]
+            if len(state) > 2:
+                self.pitchMotor.setlearned(state[2]["pitch"])
+                self.rollMotor.setlearned(state[2]["roll"])
             log.info("restored position from [%s pitch=%d roll=%d]" % (self.statefile,
                                                                        self.pitchMotor.pos,
                                                                        self.rollMotor.pos))
@@ -204,6 +252,137 @@ class TrackerDriver:
             self.savestate()
 
 
+class PositionGrid:
+    """
+      precomputed (pitchpos, rollpos) of a TrackerDriver on an azimuth x elevation grid,
+      azimuth already corrected by the driver azioffset; positions are interpolated
+      bilinearly. Cells where interpolation can be off by more than 'tolerance' pulses
+      (e.g. where an angle is clipped or pitch flips at the horizon) are marked exact
+      and lookup() returns None there. Building requires numpy; the grid is pickled to
+      filename and rebuilt when the motor geometry changes.
+    """
+    VERSION = 2
+    SUBSTEPS = 4
+    MARGIN = 2.0
+
+    def __init__(self, driver, filename=None, step=1.0, tolerance=1.0):
+        self.step = step
+        self.tolerance = tolerance
+        self.key = self.geometrykey(driver, step, tolerance)
+        if filename and self.load(filename):
+            log.info("position grid loaded from [%s], max error %f pulses" % (filename, self.maxerror))
+            return
+        t = time.time()
+        self.build(driver)
+        log.info("position grid built in %f s: %d cells, %d exact, max error %f pulses" %
+                 (time.time() - t, len(self.exact), sum(self.exact), self.maxerror))
+        if filename:
+            self.save(filename)
+
+    def geometrykey(self, driver, step, tolerance):
+        """hash of everything the grid depends on"""
+        geometry = [self.VERSION, step, tolerance]
+        for m in (driver.pitchMotor, driver.rollMotor):
+            geometry += [m.ab, m.bc, m.cd, m.d, m.offset, m.hookoffset, m.pulseStep, m.minAngle, m.maxAngle]
+        return hashlib.sha1(repr(geometry)).hexdigest()
+
+    def build(self, driver):
+        self.naz = int(round(360.0 / self.step)) + 1
+        self.nele = int(round(90.0 / self.step)) + 1
+        # positions on a grid 'SUBSTEPS' times finer, to measure the interpolation error inside the cells
+        f = self.SUBSTEPS
+        az, ele = np.meshgrid(np.arange(f * (self.naz - 1) + 1) * self.step / f,
+                              np.arange(f * (self.nele - 1) + 1) * self.step / f)
+        saved = driver.aziOffset
+        driver.aziOffset = 0
+        try:
+            fine = driver.aziele2pos_array(az, ele)[2:]
+        finally:
+            driver.aziOffset = saved
+
+        # bound of the interpolation error of every cell, for both motors: the error
+        # at the fine points, plus what it can grow between them, which is at most
+        # 1/8 of the second differences along azimuth and elevation (the
+        # interpolation has none), counted MARGIN times for their variation
+        err = 0.0
+        for values in fine:
+            nodes = values[::f, ::f]
+            d2 = self.seconddifferences(values)
+            for i in xrange(f + 1):
+                for j in xrange(f + 1):
+                    u = float(j) / f
+                    v = float(i) / f
+                    interpolated = ((nodes[:-1, :-1] * (1 - u) + nodes[:-1, 1:] * u) * (1 - v) +
+                                    (nodes[1:, :-1] * (1 - u) + nodes[1:, 1:] * u) * v)
+                    computed = values[i:i + f * (self.nele - 1):f, j:j + f * (self.naz - 1):f]
+                    between = d2[i:i + f * (self.nele - 1):f, j:j + f * (self.naz - 1):f] * self.MARGIN / 8
+                    err = np.maximum(err, np.abs(computed - interpolated) + between)
+        exact = err > self.tolerance
+        self.pitch = array('d', fine[0][::f, ::f].ravel())
+        self.roll = array('d', fine[1][::f, ::f].ravel())
+        self.exact = bytearray(exact.ravel().astype(np.uint8).tostring())
+        self.maxerror = float(err[~exact].max()) if not exact.all() else 0.0
+
+    @staticmethod
+    def seconddifferences(values):
+        """
+          |second difference| along azimuth plus along elevation at every point,
+          the largest of the point and its neighbours
+        """
+        d2 = np.zeros(values.shape)
+        d2[:, 1:-1] += np.abs(values[:, 2:] - 2 * values[:, 1:-1] + values[:, :-2])
+        d2[1:-1, :] += np.abs(values[2:, :] - 2 * values[1:-1, :] + values[:-2, :])
+        padded = np.pad(d2, 1, "edge")
+        rows, cols = values.shape
+        for i in xrange(3):
+            for j in xrange(3):
+                d2 = np.maximum(d2, padded[i:i + rows, j:j + cols])
+        return d2
+
+    def lookup(self, az, alt):
+        """
+          return interpolated (pitchpos, rollpos), None outside the grid or in exact cells
+        """
+        if alt < 0 or alt > 90:
+            return None
+        fa = (az % 360.0) / self.step
+        fe = alt / self.step
+        ia = min(int(fa), self.naz - 2)
+        ie = min(int(fe), self.nele - 2)
+        if self.exact[ie * (self.naz - 1) + ia]:
+            return None
+        u = fa - ia
+        v = fe - ie
+        k = ie * self.naz + ia
+        n = self.naz
+        p = self.pitch
+        r = self.roll
+        pitchpos = (p[k] * (1 - u) + p[k + 1] * u) * (1 - v) + (p[k + n] * (1 - u) + p[k + n + 1] * u) * v
+        rollpos = (r[k] * (1 - u) + r[k + 1] * u) * (1 - v) + (r[k + n] * (1 - u) + r[k + n + 1] * u) * v
+        return pitchpos, rollpos
+
+    def save(self, filename):
+        output = open(filename, 'wb')
+        pickle.dump((self.key, self.naz, self.nele, self.pitch, self.roll, self.exact, self.maxerror), output, 2)
+        output.close()
+        log.info("position grid saved [%s]" % filename)
+
+    def load(self, filename):
+        """
+          load the grid from filename, False if missing or built for another geometry
+        """
+        if not os.path.exists(filename):
+            return False
+        inputhandle = open(filename, 'rb')
+        state = pickle.load(inputhandle)
+        inputhandle.close()
+        if state[0] != self.key:
+            log.info("position grid [%s] is for another geometry: rebuilding" % filename)
+            return False
+        self.key, self.naz, self.nele, self.pitch, self.roll, self.exact, self.maxerror = state
+        return True
+
+
 def gpio_out(port, value, label=""):
     # import RPi.GPIO as GPIO
     # GPIO.output (port,value)
@@ -12,15 +12,18 @@ import re
 import SocketServer
 import linearmotor
 import trackerdriver
+import pulsecounter
+import gpiobackend
 import ConfigParser
 
-cback = {}
+counters = []
 broadCom = {19: 10, 21: 9, 22: 25, 15: 22, 16: 23, 18: 24}
 motorCmd = re.compile("(roll|pitch) +((calibrate)|(a) ([-+]?[\d.]+)|(p) ([\d.]+))")
 prCmd = re.compile("(pitchroll) +((a) ([-+]?[\d.]+),([-+]?[\d.]+)|(p) ([\d.]+),([\d.]+))")
 aeCmd = re.compile("(ae) +(([\d.]+),([\d.]+))")
 lockCmd = re.compile("(lock) +(on|off|@a ([-+]?[\d.]+),([-+]?[\d.]+))")
 statusCmd = re.compile("(getstatus|gs)")
+calibrateCmd = re.compile("(calibrate) +(both)")
 
 locked = False
 
@@ -61,7 +64,7 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
         log.debug("{} wrote:".format(self.client_address[0]))
         log.debug("[%s]" % (data))
         #
-        # commands: roll <calibrate|step>
+        # commands: roll <calibrate|step>, calibrate both
         #
 
         cmd = False
@@ -73,7 +76,20 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
             h.write("config-file: %s\n" % configFile)
             h.write("lock-status: %s\n" % locked)
             h.write("pitch-motor-position: %d\n" % tDriver.pitchMotor.pos)
-            h.write("roll-motor-position: %d" % tDriver.rollMotor.pos)
+            h.write("roll-motor-position: %d\n" % tDriver.rollMotor.pos)
+            h.write("pitch-angle: %f\n" % tDriver.pitchMotor.pos2angle(tDriver.pitchMotor.pos))
+            h.write("roll-angle: %f" % tDriver.rollMotor.pos2angle(tDriver.rollMotor.pos))
+            for motor in (tDriver.pitchMotor, tDriver.rollMotor):
+                h.write("\n%s-final-error: %d moves, mean %.2f, max %d pulses" % ((motor.name.strip("[]"),) +
+                                                                                 motor.finalerrorstats()))
+                if motor.lastCalibration is not None:
+                    h.write("\n%s-last-calibration: %s, %.1f s, drift %s pulses" % (
+                        (motor.name.strip("[]"), time.ctime(motor.lastCalibration[0])) + motor.lastCalibration[1:]))
+                if motor.cache is not None:
+                    h.write("\n%s-angle2pos-cache: %d hits, %d misses" % (motor.name.strip("[]"), motor.cacheHits,
+                                                                         motor.cacheMisses))
+            for line in backend.latencysummary():
+                h.write("\ngpio-%s" % line)
             cmd = "getstatus"
 
         match = motorCmd.match(data)
@@ -118,6 +134,17 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
                 log.info("locked: ignoring executing [%s %s]" % (match.group(1), match.group(2)))
                 h.write("locked: ignoring executing [%s %s]" % (match.group(1), match.group(2)))
 
+        match = calibrateCmd.match(data)
+        if match:
+            cmd = "calibrate"
+            if not locked:
+                log.info("executing [%s %s]" % (match.group(1), match.group(2)))
+                h.write("executing [%s %s]" % (match.group(1), match.group(2)))
+                tDriver.calibrateboth()
+            else:
+                log.info("locked: ignoring executing [%s %s]" % (match.group(1), match.group(2)))
+                h.write("locked: ignoring executing [%s %s]" % (match.group(1), match.group(2)))
+
         match = lockCmd.match(data)
         if match:
             cmd = "lock"
@@ -151,57 +178,40 @@ class MyTCPHandler(SocketServer.BaseRequestHandler):
 
 
 def setup_gpio():
-    global pi1
-    global simulation
+    global backend
     global config
-    if simulation:
-        return
-
-    if iolib == "GPIO":
-        # use P1 header pin numbering convention
-        GPIO.setmode(GPIO.BOARD)
-
-        # pitch
-        GPIO.setup(config.getint("pitch", "powerport"), GPIO.OUT)  # pitch power
-        GPIO.setup(config.getint("pitch", "dirport"), GPIO.OUT)  # pitch dir
-        GPIO.setup(config.getint("pitch", "pulseport"), GPIO.IN, pull_up_down=GPIO.PUD_UP)  # pitch sensor
-
-        # roll
-        GPIO.setup(config.getint("roll", "powerport"), GPIO.OUT)  # roll power
-        GPIO.setup(config.getint("roll", "dirport"), GPIO.OUT)  # roll dir
-        GPIO.setup(config.getint("roll", "pulseport"), GPIO.IN, pull_up_down=GPIO.PUD_UP)  # roll sensor
 
+    if simulation:
+        backend = gpiobackend.SimulatedBackend(broadCom)
+    elif iolib == "GPIO":
+        backend = gpiobackend.RPiGpioBackend()
     elif iolib == "pigpio":
-        pi1 = pigpio.pi()
-        # pitch
-        pi1.set_mode(broadCom[config.getint("pitch", "powerport")], pigpio.OUTPUT)
-        pi1.set_mode(broadCom[config.getint("pitch", "dirport")], pigpio.OUTPUT)
-        pi1.set_mode(broadCom[config.getint("pitch", "pulseport")], pigpio.INPUT)
-        pi1.set_pull_up_down(broadCom[config.getint("pitch", "pulseport")], pigpio.PUD_UP)
-
-        # roll
-        pi1.set_mode(broadCom[config.getint("roll", "powerport")], pigpio.OUTPUT)
-        pi1.set_mode(broadCom[config.getint("roll", "dirport")], pigpio.OUTPUT)
-        pi1.set_mode(broadCom[config.getint("roll", "pulseport")], pigpio.INPUT)
-        pi1.set_pull_up_down(broadCom[config.getint("roll", "pulseport")], pigpio.PUD_UP)
-
-    else:
-        pass
+        backend = gpiobackend.PigpioBackend(broadCom)
+    elif iolib == "fake":
+        speedup = 1.0
+        if config.has_option("fake", "speedup"):
+            speedup = config.getfloat("fake", "speedup")
+        backend = gpiobackend.FakeBackend(broadCom, speedup)
+
+    actuator = {}
+    for option in ("rate", "reverserate", "spinup", "coast", "glitch"):
+        if config.has_option("fake", option):
+            actuator[option] = config.getfloat("fake", option)
+    if config.has_option("fake", "travel"):
+        actuator["travel"] = config.getint("fake", "travel")
+
+    for axis in ("pitch", "roll"):
+        ports = [config.getint(axis, port) for port in ("powerport", "dirport", "pulseport")]
+        backend.setup_motor(*ports)
+        if backend.name == "fake":
+            backend.addmotor(*ports, **actuator)
 
 
 def cleanup_gpio():
     global config
-    global pi1
-    if simulation:
-        return
-    if iolib == "GPIO":
-        GPIO.output(config.getint("pitch", "powerport"), 0)
-        GPIO.output(config.getint("roll", "powerport"), 0)
-        GPIO.cleanup()
-    elif iolib == "pigpio":
-        pi1.stop()
-    else:
-        pass
+    for counter in counters:
+        counter.close()
+    backend.cleanup((config.getint("pitch", "powerport"), config.getint("roll", "powerport")))
 
 
 def usage():
@@ -249,6 +259,9 @@ if __name__ == "__main__":
     statefile = config.get("globals", "statefile")
     log = config.get("globals", "log")
     iolib = config.get("globals", "iolib")
+    pulsecounting = "callback"
+    if config.has_option("globals", "pulsecounting"):
+        pulsecounting = config.get("globals", "pulsecounting")
 
     # log stuffs
 
@@ -277,9 +290,14 @@ if __name__ == "__main__":
     logm.addHandler(fh)
     logm.addHandler(ch)
     linearmotor.log = logm
+    gpiobackend.log = logm
 
-    if iolib not in ("GPIO", "pigpio"):
-        log.error("invalid iolib [%s]: must be GPIO or pigpio" % (iolib))
+    if iolib not in ("GPIO", "pigpio", "fake"):
+        log.error("invalid iolib [%s]: must be GPIO, pigpio or fake" % (iolib))
+        sys.exit(1)
+    if pulsecounting not in ("callback", "script"):
+        log.error("invalid pulsecounting [%s]: must be callback or script" % pulsecounting)
+        sys.exit(1)
 
     log.info("using iolib [%s]" % (iolib))
     if angleOffset != 0:
@@ -287,77 +305,29 @@ if __name__ == "__main__":
 
     log.info("statefile [%s]" % (statefile))
 
-    # selective imports
-    if not simulation:
-        if iolib == "pigpio":
-            import pigpio
-
-        if iolib == "GPIO":
-            import RPi.GPIO as GPIO
-
     setup_gpio()
 
     log.info("Starting server on port [%d], simulation [%s]" % (PORT, simulation))
 
-    if not simulation:
-
-        if iolib == "GPIO":
-            # define functions for GPIO library
-
-            def gpio_out(port, value, label=""):
-                GPIO.output(port, value)
-                log.info("%s setted GPIO %d to %d" % (label, port, value))
-
-            def gpio_in(port):
-                return GPIO.input(port)
-
-            # set edgeCallBack function
-            def set_edgecallbackfn(port, fn, label=""):
-                log.info("%s set edge callback on port # %d" % (label, port))
-                GPIO.add_event_detect(port, GPIO.BOTH, callback=fn, bouncetime=2)
-
-            def cancelcallback(port, label=""):
-                log.info("%s cancel callback fn for port : # %d" % (label, port))
-                GPIO.remove_event_detect(port)
-
-        elif iolib == "pigpio":
-            def gpio_out(port, value, label=""):
-                # ALL gpios are identified by their Broadcom number
-                pi1.write(broadCom[port], value)
-
-            def gpio_in(port):
-                return pi1.read(broadCom[port])
-
-            def set_edgecallbackfn(port, fn, label=""):
-                global cback
-                log.info("%s set edge callback fn for port # %d" % (label, port))
-                if port in cback.keys():
-                    cback[port].cancel()
-                cback[port] = pi1.callback(broadCom[port], pigpio.EITHER_EDGE, fn)
-
-            def cancelcallback(port, label=""):
-                global cback
-                log.info("%s cancel callback on port # %d" % (label, port))
-                if port in cback.keys():
-                    cback[port].cancel()
-
-        else:
-            pass
-    else:
-
-        def gpio_out(port, value, label=""):
-            # import RPi.GPIO as GPIO
-            # GPIO.output (port,value)
-            log.info("%s simulate setting GPIO %d to %d" % (label, port, value))
-
-        def gpio_in(port):
-            log.info("simulated read GPIO # %d" % (port))
-
-        def set_edgecallbackfn(port, fn, label=""):
-            log.info("%s simulated set edge callback fn on port # %d" % (label, port))
-
-        def cancelcallback(port, label=""):
-            log.info("%s simulated cancel callback for port # %d" % (label, port))
+    if pulsecounting == "script" and (simulation or iolib != "pigpio"):
+        log.warn("pulsecounting [script] requires pigpio: using callbacks")
+        pulsecounting = "callback"
+    if pulsecounting == "script":
+        pigpiod = "localhost:8888"
+        if config.has_option("globals", "pigpiod"):
+            pigpiod = config.get("globals", "pigpiod")
+        host, port = pigpiod.split(":")
+        pigpiodClient = pulsecounter.PigpiodClient(host, int(port))
+        log.info("counting pulses in pigpiod [%s]" % pigpiod)
+
+    def setpulsecounting(motor):
+        if pulsecounting == "script":
+            counter = pulsecounter.PulseCounter(pigpiodClient, broadCom[motor.pulsePort], broadCom[motor.powerPort])
+            counters.append(counter)
+            motor.setpulsecounter(counter)
+
+    # relays of both motors switched together, see TrackerDriver.relays
+    gpioBank = linearmotor.GpioBank(backend.write, backend.bank_write if backend.BANK else None, backend.bitmap)
 
     pitchMotor = linearmotor.LinearMotor(
         "[pitch]",
@@ -373,10 +343,9 @@ if __name__ == "__main__":
         hookoffset=config.getfloat("pitch", "hookoffset"),
         minstep=config.getint("pitch", "minstep"))
 
-    pitchMotor.set_gpioout(gpio_out)
-    pitchMotor.set_gpioin(gpio_in)
-    pitchMotor.set_edgepulsecallbackfn(set_edgecallbackfn)
-    pitchMotor.set_cancelpulsecallbackfn(cancelcallback)
+    pitchMotor.setbackend(backend)
+    gpioBank.attach(pitchMotor)
+    setpulsecounting(pitchMotor)
 
     if config.has_option("pitch", "minangle"):
         pitchMotor.minAngle = config.getfloat("pitch", "minangle")
@@ -384,6 +353,10 @@ if __name__ == "__main__":
     if config.has_option("pitch", "maxangle"):
         pitchMotor.maxAngle = config.getfloat("pitch", "maxangle")
         log.info("Pitch motor has a max angle %f" % pitchMotor.maxAngle)
+    if config.has_option("pitch", "anglecache"):
+        pitchMotor.setangle2poscache(config.getfloat("pitch", "anglecache"))
+    if config.has_option("pitch", "calibratestall"):
+        pitchMotor.calibrateStall = config.getfloat("pitch", "calibratestall")
 
     rollMotor = linearmotor.LinearMotor(
         "[roll]",
@@ -399,10 +372,9 @@ if __name__ == "__main__":
         hookoffset=config.getfloat("roll", "hookoffset"),
         minstep=config.getint("roll", "minstep"))
 
-    rollMotor.set_gpioout(gpio_out)
-    rollMotor.set_gpioin(gpio_in)
-    rollMotor.set_edgepulsecallbackfn(set_edgecallbackfn)
-    rollMotor.set_cancelpulsecallbackfn(cancelcallback)
+    rollMotor.setbackend(backend)
+    gpioBank.attach(rollMotor)
+    setpulsecounting(rollMotor)
 
     if config.has_option("roll", "minangle"):
         rollMotor.minAngle = config.getfloat("roll", "minangle")
@@ -410,8 +382,23 @@ if __name__ == "__main__":
     if config.has_option("roll", "maxangle"):
         rollMotor.maxAngle = config.getfloat("roll", "maxangle")
         log.info("Roll motor has a max angle %f" % rollMotor.maxAngle)
+    if config.has_option("roll", "anglecache"):
+        rollMotor.setangle2poscache(config.getfloat("roll", "anglecache"))
+    if config.has_option("roll", "calibratestall"):
+        rollMotor.calibrateStall = config.getfloat("roll", "calibratestall")
 
     tDriver = trackerdriver.TrackerDriver(pitchMotor, rollMotor, angleOffset, statefile=statefile)
+    tDriver.gpioBank = gpioBank
+    if backend.name == "fake":
+        # the virtual actuators start where the motors were left
+        for motor in (pitchMotor, rollMotor):
+            backend.motors[motor.powerPort].pos = int(round(motor.pos))
+
+    if config.has_option("globals", "positiongrid"):
+        if trackerdriver.np is None:
+            log.warn("positiongrid requires numpy: disabled")
+        else:
+            tDriver.positionGrid = trackerdriver.PositionGrid(tDriver, config.get("globals", "positiongrid"))
     # if statefile and os.path.isfile(statefile):
     #    tDriver.restoreState (statefile)
 